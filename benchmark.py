@@ -0,0 +1,272 @@
+import sys, csv, os, io, json, time, random, argparse, platform, tempfile, subprocess, contextlib
+import spacy
+import script
+
+#Stages of script.py that are timed on their own, in the order they run
+STAGES = ["convertcsv", "split_sentences", "iterate_query", "analyze_proper_nouns", "export_csv"]
+
+ASK_CHAT_HEADERS = ["id", "guest", "protocol", "profile", "queue", "started", "wait", "duration", "operator", "ip", "referrer", "transcript"]
+JIRA_HEADERS = ["Summary", "Issue key", "Issue id", "Issue Type", "Status", "Project key", "Project name", "Project type", "Project url", "Priority", "Resolution", "Assignee", "Reporter", "Created", "Updated", "Last Viewed", "Resolved", "Description"]
+
+#Words that do not trigger any query rule
+FILLER_WORDS = ["the", "a", "to", "and", "of", "i", "you", "is", "for", "can", "how", "find", "article", "please", "thanks", "help", "my", "need", "looking", "with", "on", "this", "that", "search", "there", "journal", "access", "ok", "sure", "one", "moment"]
+#Words that trigger the built-in rules of TermMatcher
+RULE_WORDS = ["library", "libraries", "nvivo", "references", "citation", "protocol", "grad", "graduate", "master's", "MA", "MSc", "M.Sc", "thesis.pdf", "data.csv", "notes.docx", "utsc.utoronto.ca", "CSCA08H3", "MATA31", "ANT101", "ECO100Y1"]
+#Capitalized words for spaCy to find proper nouns in
+PROPER_NOUNS = ["Toronto", "Scarborough", "Mary", "Smith", "Robarts", "Gerstein", "Ontario", "Canada", "JSTOR", "ProQuest", "Statistics Canada", "Jane Doe", "Monday", "March"]
+CANNED_LINES = ["Welcome to Ask a Librarian. A librarian will be with you shortly.", "System message: Transferring chat to another queue.", "Thank you for using Ask a Librarian!"]
+
+#Slowdowns smaller than this many seconds are treated as noise by compare()
+MIN_REGRESSION_SECONDS = 0.05
+
+def generate_terms(count):
+    """
+    Return a list of query terms, starting with the terms in text_terms_DS.txt and adding made up terms until there are count terms.
+    Parameters:
+        count: The number of terms in the list
+    """
+    terms = script.initialize_query_return_data(script.convertcsv("text_terms_DS.txt")[0])[:count]
+    for i in range(len(terms), count):
+        terms.append("Term" + str(i))
+    return terms
+
+def generate_line(rng, terms, words, hit_density):
+    """
+    Return a line of made up text.
+    Parameters:
+        rng: A random.Random
+        terms: A list of query terms to draw hits from
+        words: The number of words in the line
+        hit_density: The chance of each word being a query term or a word that triggers a built-in rule
+    """
+    line = []
+    for i in range(words):
+        chance = rng.random()
+        if chance < hit_density / 2:
+            line.append(rng.choice(terms))
+        elif chance < hit_density:
+            line.append(rng.choice(RULE_WORDS))
+        elif chance < hit_density + 0.05:
+            line.append(rng.choice(PROPER_NOUNS))
+        else:
+            line.append(rng.choice(FILLER_WORDS))
+    return " ".join(line)
+
+def generate_ask_chat_csv(filename, rng, terms, chats, lines_per_chat, hit_density):
+    """
+    Write a made up Ask Chat export to filename.
+    Parameters:
+        filename: The name of the file to write
+        rng: A random.Random
+        terms: A list of query terms to draw hits from
+        chats: The number of chats in the file
+        lines_per_chat: The average number of lines in each chat
+        hit_density: The chance of each word being a hit
+    """
+    with open(filename, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(ASK_CHAT_HEADERS)
+        for i in range(chats):
+            guest = "guest" + str(i) + "@10.0." + str(i % 256) + ".1"
+            operator = rng.choice(["johntest_tor", "janedoe_tor", "asmith_yor", "bwong_mcm"])
+            lines = [CANNED_LINES[0]]
+            for j in range(rng.randint(1, 2 * lines_per_chat - 1)):
+                speaker = operator if rng.random() < 0.5 else guest
+                if rng.random() < 0.05:
+                    lines.append(rng.choice(CANNED_LINES))
+                else:
+                    lines.append("%02d:%02d:%02d %s: %s" % (12 + j // 3600, j // 60 % 60, j % 60, speaker, generate_line(rng, terms, rng.randint(2, 25), hit_density)))
+            started = "2021-%02d-%02d 12:00:00" % (1 + i % 12, 1 + i % 28)
+            writer.writerow([str(100000 + i), guest, "web", "utsc", "scarborough", started, str(rng.randint(0, 300)), str(rng.randint(60, 3600)), operator, "10.0." + str(i % 256) + ".1", "https://library.utsc.utoronto.ca/help/page/", "\n".join(lines)])
+
+def generate_jira_csv(filename, rng, terms, tickets, lines_per_ticket, hit_density):
+    """
+    Write a made up JIRA export to filename.
+    Parameters:
+        filename: The name of the file to write
+        rng: A random.Random
+        terms: A list of query terms to draw hits from
+        tickets: The number of tickets in the file
+        lines_per_ticket: The average number of lines in each ticket description
+        hit_density: The chance of each word being a hit
+    """
+    with open(filename, 'w') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(JIRA_HEADERS)
+        for i in range(tickets):
+            description = "\n".join(generate_line(rng, terms, rng.randint(0, 25), hit_density) for j in range(rng.randint(1, 2 * lines_per_ticket - 1)))
+            created = "2021-%02d-%02d 12:00" % (1 + i % 12, 1 + i % 28)
+            writer.writerow([generate_line(rng, terms, 6, hit_density), "DS-" + str(i), str(10000 + i), rng.choice(["Task", "Bug", "Story"]), "Done", "DS", "Digital Scholarship", "software", "https://jira.example.org/DS", "Medium", "Done", "", "", created, created, created, created, description])
+
+def stage_result(seconds, lines, hits):
+    """
+    Return the measurements of a stage as a dict.
+    """
+    return {"seconds": seconds, "lines_per_second": lines / seconds if seconds else None, "hits_per_second": hits / seconds if seconds else None}
+
+def run_stages(mode, filename, export_filename, matcher):
+    """
+    Run each stage of script.py on a file, timing each one on its own.
+    Parameters:
+        mode: The mode of the file, either ask_chat or jira
+        filename: The name of the file to analyze
+        export_filename: The name of the file to export to
+        matcher: A TermMatcher built from the terms to query for
+    Returns:
+        A dict with the measurements of each stage, and the number of rows, lines and hits
+    """
+    script.MODE = mode
+    timings = {}
+    start = time.perf_counter()
+    data, headers = script.convertcsv(filename)
+    timings["convertcsv"] = time.perf_counter() - start
+    script.get_data_array_text_location(headers)
+    start = time.perf_counter()
+    data = script.split_sentences(data)
+    timings["split_sentences"] = time.perf_counter() - start
+    start = time.perf_counter()
+    data = script.iterate_query(data, matcher)
+    timings["iterate_query"] = time.perf_counter() - start
+    start = time.perf_counter()
+    data = script.analyze_proper_nouns(data)
+    timings["analyze_proper_nouns"] = time.perf_counter() - start
+    start = time.perf_counter()
+    script.export_csv(data, headers, export_filename)
+    timings["export_csv"] = time.perf_counter() - start
+    lines = sum(chat_log.line_count() for chat_log in data)
+    hits = sum(len(chat_log.hits) for chat_log in data)
+    return {"rows": len(data), "lines": lines, "hits": hits, "stages": {stage: stage_result(timings[stage], lines, hits) for stage in STAGES}}
+
+def run_end_to_end(mode, filename, export_filename, matcher):
+    """
+    Return the number of seconds it takes to analyze and export a file the way script.py does.
+    """
+    script.MODE = mode
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        script.add_file_data(filename, matcher, [], export_filename)
+    return time.perf_counter() - start
+
+def run_benchmark(mode, directory, rng, terms, args):
+    """
+    Generate a file for mode and measure each stage and the whole run, keeping the fastest of args.repeat runs.
+    Returns:
+        A dict of results for the mode
+    """
+    filename = os.path.join(directory, mode + ".csv")
+    export_filename = os.path.join(directory, mode + "_export.csv")
+    if mode == "ask_chat":
+        generate_ask_chat_csv(filename, rng, terms, args.chats, args.lines, args.hit_density)
+    else:
+        generate_jira_csv(filename, rng, terms, args.chats, args.lines, args.hit_density)
+    matcher = script.TermMatcher(terms)
+    result = None
+    for i in range(args.repeat):
+        run = run_stages(mode, filename, export_filename, matcher)
+        run["end_to_end"] = stage_result(run_end_to_end(mode, filename, export_filename, matcher), run["lines"], run["hits"])
+        if result is None:
+            result = run
+        else:
+            for stage in STAGES:
+                if run["stages"][stage]["seconds"] < result["stages"][stage]["seconds"]:
+                    result["stages"][stage] = run["stages"][stage]
+            if run["end_to_end"]["seconds"] < result["end_to_end"]["seconds"]:
+                result["end_to_end"] = run["end_to_end"]
+    result["input_bytes"] = os.path.getsize(filename)
+    result["export_bytes"] = os.path.getsize(export_filename)
+    return result
+
+def get_revision():
+    """
+    Return the git commit of the working directory, or None if it is not a git repository.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """
+    Print the time of each stage against a baseline.
+    Parameters:
+        results: The results of this run
+        baseline: The results of an earlier run, loaded from its JSON file
+        threshold: The fraction a stage may slow down by before it counts as a regression, as long as it also slows down by more than MIN_REGRESSION_SECONDS
+    Returns:
+        A list of the stages that regressed, in format mode/stage
+    """
+    regressions = []
+    print("Compared to", baseline.get("revision") or "baseline")
+    for mode in results["results"]:
+        if mode not in baseline["results"]:
+            continue
+        old = baseline["results"][mode]
+        new = results["results"][mode]
+        for stage in STAGES + ["end_to_end"]:
+            old_seconds = old["end_to_end"]["seconds"] if stage == "end_to_end" else old["stages"][stage]["seconds"]
+            new_seconds = new["end_to_end"]["seconds"] if stage == "end_to_end" else new["stages"][stage]["seconds"]
+            ratio = new_seconds / old_seconds if old_seconds else float("inf")
+            flag = ""
+            if ratio > 1 + threshold and new_seconds - old_seconds > MIN_REGRESSION_SECONDS:
+                flag = "REGRESSION"
+                regressions.append(mode + "/" + stage)
+            print("  %-8s %-22s %9.3fs -> %9.3fs  x%.2f %s" % (mode, stage, old_seconds, new_seconds, ratio, flag))
+    return regressions
+
+def parse_arguments(argv):
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the stages of script.py on generated Ask Chat and JIRA files.")
+    parser.add_argument("--mode", choices=["ask_chat", "jira", "both"], default="both", help="The type of file to benchmark (default: both)")
+    parser.add_argument("--chats", type=int, default=2000, help="The number of chats or tickets in each file (default: 2000)")
+    parser.add_argument("--lines", type=int, default=20, help="The average number of lines in each chat or ticket (default: 20)")
+    parser.add_argument("--hit-density", type=float, default=0.05, help="The chance of each word being a query term or a built-in rule hit (default: 0.05)")
+    parser.add_argument("--terms", type=int, default=len(script.convertcsv("text_terms_DS.txt")[0]), help="The number of query terms, padded with made up terms (default: the terms in text_terms_DS.txt)")
+    parser.add_argument("--seed", type=int, default=0, help="The seed for generating files (default: 0)")
+    parser.add_argument("--repeat", type=int, default=1, help="The number of runs to keep the fastest of (default: 1)")
+    parser.add_argument("--output", metavar="FILE", help="Write the results to a JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="Compare the results to a JSON file written by an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="The fraction a stage may slow down by before --compare reports a regression (default: 0.1)")
+    args = parser.parse_args(argv)
+    if args.chats < 1 or args.lines < 1 or args.terms < 1 or args.repeat < 1:
+        parser.error("--chats, --lines, --terms and --repeat must be at least 1")
+    if not 0 <= args.hit_density <= 1:
+        parser.error("--hit-density must be between 0 and 1")
+    return args
+
+def main():
+    args = parse_arguments(sys.argv[1:])
+    modes = ["ask_chat", "jira"] if args.mode == "both" else [args.mode]
+    rng = random.Random(args.seed)
+    terms = generate_terms(args.terms)
+    results = {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "spacy": spacy.__version__,
+        "model": script.get_model_name(),
+        "parameters": {"chats": args.chats, "lines": args.lines, "hit_density": args.hit_density, "terms": args.terms, "seed": args.seed, "repeat": args.repeat},
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in modes:
+            results["results"][mode] = run_benchmark(mode, directory, rng, terms, args)
+            result = results["results"][mode]
+            print(mode + ":", result["rows"], "rows,", result["lines"], "lines,", result["hits"], "hits")
+            for stage in STAGES:
+                print("  %-22s %9.3fs %12.0f lines/s" % (stage, result["stages"][stage]["seconds"], result["stages"][stage]["lines_per_second"] or 0))
+            print("  %-22s %9.3fs %12.0f lines/s %12.0f hits/s" % ("end to end", result["end_to_end"]["seconds"], result["end_to_end"]["lines_per_second"] or 0, result["end_to_end"]["hits_per_second"] or 0))
+    #The peak of the whole benchmark process, since resident memory is not released back between stages or runs
+    results["peak_rss_kb"] = script.get_peak_memory()["main"]
+    print("Peak RSS:", "n/a" if results["peak_rss_kb"] is None else str(results["peak_rss_kb"]) + " KB")
+    if args.output:
+        with open(args.output, 'w') as jsonfile:
+            json.dump(results, jsonfile, indent=2)
+    if args.compare:
+        with open(args.compare) as jsonfile:
+            baseline = json.load(jsonfile)
+        if compare(results, baseline, args.threshold):
+            exit(1)
+
+if __name__ == "__main__":
+    main()
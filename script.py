@@ -1,14 +1,131 @@
-import sys, csv, re, time
-import spacy
-from spacy import displacy
-import math
-import en_core_web_sm
-nlp = spacy.load("en_core_web_sm")
+import sys, os, csv, re, time, bisect, argparse, collections, multiprocessing, sqlite3, hashlib, json, array, functools, contextlib
+import math, importlib.util, importlib.metadata, threading, socketserver, io, signal, mmap
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#The spaCy model used to find proper nouns
+NER_MODEL = "en_core_web_sm"
+#Pipeline components that are not needed to find proper nouns, and are not loaded
+NER_EXCLUDED_COMPONENTS = ["tagger", "parser", "senter", "attribute_ruler", "lemmatizer"]
+#The spaCy pipeline, loaded by get_nlp() the first time it is needed
+nlp = None
+#Whether to find proper nouns, and the number of logs spaCy analyzes at a time
+ner_enabled = True
+ner_batch_size = 1000
+
+#Whether to export a row for each hit, and summary tables of the hits
+export_hits = True
+export_summary = False
 
 #Text to analyze for query data and proper nouns must be in the column with index data_array_text_location
 #JIRA csv files have varying locations for this column, so function get_jira_data_array_text_location() is used
 data_array_text_location = 11
 
+class Metrics:
+    """
+    Collects timings and counts for a run: the wall and CPU time and the amount of data processed by each stage, the number of calls, total time and hits of each query rule, how many hits each term found and how fast spaCy analyzed logs.
+    Metrics are only collected while the global variable metrics holds a Metrics object. Worker processes collect their own, which are merged into the main process with merge().
+    """
+    def __init__(self):
+        self.stages = {} #Stage name -> dict of calls, wall and CPU seconds, rows, lines and characters
+        self.rules = {} #Query rule name -> dict of calls, seconds and hits
+        self.term_hits = {} #Term -> number of hits
+        self.ner = {"pipe_calls": 0, "batches": 0, "docs": 0, "cached_docs": 0, "seconds": 0}
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=0, lines=0, characters=0):
+        """
+        Time the code run inside a with statement as a stage.
+        Parameters:
+            name: The name of the stage
+            rows, lines, characters: The amount of data the stage processed
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        yield
+        self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu, rows, lines, characters)
+
+    def add_stage(self, name, wall_seconds, cpu_seconds, rows=0, lines=0, characters=0):
+        stage = self.stages.setdefault(name, {"calls": 0, "wall_seconds": 0, "cpu_seconds": 0, "rows": 0, "lines": 0, "characters": 0})
+        stage["calls"] += 1
+        stage["wall_seconds"] += wall_seconds
+        stage["cpu_seconds"] += cpu_seconds
+        stage["rows"] += rows
+        stage["lines"] += lines
+        stage["characters"] += characters
+
+    def add_rule(self, name, seconds, hits):
+        rule = self.rules.get(name)
+        if rule is None:
+            rule = self.rules[name] = {"calls": 0, "seconds": 0, "hits": 0}
+        rule["calls"] += 1
+        rule["seconds"] += seconds
+        rule["hits"] += hits
+
+    def add_term_hit(self, term):
+        self.term_hits[term] = self.term_hits.get(term, 0) + 1
+
+    def add_ner(self, docs, cached_docs, batches, seconds):
+        self.ner["pipe_calls"] += 1
+        self.ner["docs"] += docs
+        self.ner["cached_docs"] += cached_docs
+        self.ner["batches"] += batches
+        self.ner["seconds"] += seconds
+
+    def merge(self, other):
+        """
+        Add the metrics collected in other, for example by a worker process, to these metrics.
+        """
+        for name, stage in other.stages.items():
+            self.add_stage(name, stage["wall_seconds"], stage["cpu_seconds"], stage["rows"], stage["lines"], stage["characters"])
+            self.stages[name]["calls"] += stage["calls"] - 1
+        for name, rule in other.rules.items():
+            self.add_rule(name, rule["seconds"], rule["hits"])
+            self.rules[name]["calls"] += rule["calls"] - 1
+        for term, hits in other.term_hits.items():
+            self.term_hits[term] = self.term_hits.get(term, 0) + hits
+        for key, value in other.ner.items():
+            self.ner[key] += value
+
+    def to_dict(self):
+        """
+        Return the metrics as a dict that can be written as JSON. Rules are sorted by total time, slowest first.
+        """
+        ner = dict(self.ner)
+        ner["docs_per_second"] = ner["docs"] / ner["seconds"] if ner["seconds"] else None
+        return {
+            "stages": self.stages,
+            "rules": dict(sorted(self.rules.items(), key=lambda rule: rule[1]["seconds"], reverse=True)),
+            "term_hits": dict(sorted(self.term_hits.items(), key=lambda term: term[1], reverse=True)),
+            "ner": ner,
+            "peak_memory_kb": get_peak_memory(),
+        }
+
+def measure(name, rows=0, lines=0, characters=0):
+    """
+    Return a context manager that times a stage if metrics are being collected. See Metrics.stage().
+    """
+    if metrics:
+        return metrics.stage(name, rows, lines, characters)
+    return contextlib.nullcontext()
+
+def get_peak_memory():
+    """
+    Return a dict with the peak resident memory in kilobytes of this process and of the largest worker process, or None where it is not available.
+    """
+    try:
+        import resource
+    except ImportError: #Not available on Windows
+        return {"main": None, "workers": None}
+    #macOS reports bytes rather than kilobytes
+    scale = 1024 if sys.platform == "darwin" else 1
+    return {"main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale, "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale}
+
+#The Metrics being collected, or None if metrics are not being collected
+metrics = None
+
 def convertcsv(filename):
     """
     Converts a csv file to a modifiable list & return it.
@@ -26,6 +143,20 @@ def convertcsv(filename):
             data.append(row)
     return [data, headers]
 
+def set_csv_field_size_limit():
+    """
+    Raise the greatest size of a csv field from its default of 131072 characters, which long JIRA descriptions can go over, to the largest size the platform allows.
+    """
+    limit = sys.maxsize
+    while True:
+        try:
+            csv.field_size_limit(limit)
+            return
+        except OverflowError: #The limit is a C long, which is 32 bits on Windows
+            limit //= 2
+
+set_csv_field_size_limit()
+
 def get_data_array_text_location(headers):
     """
     Sets global variable data_array_text_location to the column index that will contain text to analyze.
@@ -38,31 +169,44 @@ def get_data_array_text_location(headers):
     elif MODE == 'jira':
         data_array_text_location = headers.index("Description")
 
-def patron_or_operator(chat_log, line_index):
+def classify_speaker(chat_log, words):
     """
-    Return whether a message was sent by an operator or a patron. Only applicable for ask chat logs.
+    Return whether a message was sent by an operator or a patron, using the user data at the start of the message. Only applicable for ask chat logs.
     Parameters:
-        chat_log: A chat log list
-        line_index: The index of the message to be observed in the chat log.
+        chat_log: A ChatLog
+        words: A list where each object is a string containing a word of the message
     Returns:
-        Return operator or patron if respective data was found in the message. If not, recursively call the function on the message prior to line_index
+        Return Operator or Patron if respective data was found in the message. If not, return None
     """
-    if MODE == "jira":
-        return "N/A"
-    if line_index < 0:
-        return "Unable to find"
-    if len(chat_log[data_array_text_location][line_index]) < 2:
-        return patron_or_operator(chat_log, line_index - 1)
-    text = chat_log[data_array_text_location][line_index][1].lower()
-    ip = chat_log[1]
-    profile = chat_log[3]
-    queue = chat_log[4]
-    operator = chat_log[8]
+    if len(words) < 2:
+        return None
+    text = words[1].lower()
+    ip = chat_log.row[1]
+    profile = chat_log.row[3]
+    queue = chat_log.row[4]
+    operator = chat_log.row[8]
     if "operator" in text or profile in text or queue in text or operator in text:
         return "Operator"
     if ip in text or "patron" in text:
         return "Patron"
-    return patron_or_operator(chat_log, line_index - 1)
+    return None
+
+def get_speakers(chat_log):
+    """
+    Return whether each message in a chat log was sent by an operator or a patron, in one pass over the chat log.
+    Parameters:
+        chat_log: A ChatLog
+    Returns:
+        A list with an entry for each message in the chat log. A message without operator or patron data is attributed to the message before it, or Unable to find if there is none. Every entry is N/A in jira mode.
+    """
+    if MODE == "jira":
+        return ["N/A"] * chat_log.line_count()
+    speakers = []
+    speaker = "Unable to find"
+    for j in range(chat_log.line_count()):
+        speaker = classify_speaker(chat_log, chat_log.line(j).split(" ", 2)) or speaker
+        speakers.append(speaker)
+    return speakers
 
 def get_operator_institution(operator):
     """
@@ -75,19 +219,29 @@ def get_operator_institution(operator):
     """
     return(operator[operator.find('_') + 1:])
 
+def load_operator_directory(filename):
+    """
+    Load the operator directory, indexed by operator name.
+    Parameters:
+        filename: The directory of a csv file of names, each in format [operator name, institutional suffix, real name, institution, role, campus].
+    Returns:
+        A dict mapping each operator name to a list with their role in the 0th index and sub-institution in the 1st index. If a name is listed more than once, its first entry is used.
+    """
+    names = {}
+    for name in convertcsv(filename)[0]:
+        names.setdefault(name[0], [name[4], name[5]])
+    return names
+
 def get_operator_data(operator, names):
     """
-    Check if an operator is within a given list of names, and if so, return their role and sub-institution.
+    Check if an operator is within the operator directory, and if so, return their role and sub-institution.
     Parameters:
         operator: A string in format (operator_name)_(operator_institution).
-        names: A list of names, each in format [operator name, institutional suffix, real name, institution, role, campus].
+        names: An operator directory from load_operator_directory().
     Returns:
         If a name is found in names, return a list with their role in the 0th index and sub-institution in the 1st index. Otherwise, both values are empty strings.
     """
-    for name in names:
-        if operator == name[0]:
-            return [name[4], name[5]]
-    return ["", ""]
+    return names.get(operator, ["", ""])
 
 def get_referrer_domain(link):
     """
@@ -101,109 +255,281 @@ def get_referrer_domain(link):
     """
     return(link[:link[link.find('://') + 3:].find('/') + link.find('://') + 3])
 
+class ChatLog:
+    """
+    A chat log or JIRA ticket, with the hits found in it.
+    The text of the log is kept once, as its lines with runs of whitespace replaced by single spaces, along with the offset where each line starts. Hits refer to the line they were found in by its index instead of holding a copy of the line.
+    Parameters:
+        row: A row of a csv file. The text in column with index data_array_text_location is moved into the ChatLog and replaced with an empty string.
+    """
+    __slots__ = ("row", "text", "line_starts", "speakers", "hits", "entity_text")
+
+    def __init__(self, row):
+        lines = []
+        for line in row[data_array_text_location].split('\n'):
+            words = line.split()
+            if words: #Remove sentences with no words
+                lines.append(" ".join(words))
+        row[data_array_text_location] = ""
+        self.row = row
+        self.text = "\n".join(lines)
+        #The offset of each line, followed by the offset one past the end of the text
+        self.line_starts = array.array("I", [0])
+        for line in lines:
+            self.line_starts.append(self.line_starts[-1] + len(line) + 1)
+        self.speakers = get_speakers(self)
+        #Each hit is a tuple of (hit type, hit, context, sent by, proper noun type). The context is the index of a line, or for proper nouns the start and end offsets of the context in entity_text.
+        self.hits = []
+        #The text spaCy found proper nouns in, kept if any of them are hits
+        self.entity_text = None
+
+    def line_count(self):
+        """
+        Return the number of lines in the log.
+        """
+        return len(self.line_starts) - 1
+
+    def line(self, index):
+        """
+        Return the line at index, with its words separated by single spaces.
+        """
+        return self.text[self.line_starts[index]:self.line_starts[index + 1] - 1]
+
+    def add_hit(self, hit_type, hit, context, patron_or_operator, proper_noun_type=""):
+        """
+        Add a hit to the log.
+        Parameters:
+            hit_type: The string containing the type of hit
+            hit: The string containing the text found
+            context: The index of the line the hit was found in, or a tuple of the start and end offsets of the context of a proper noun in entity_text
+            patron_or_operator: The string containing whether the message was sent by a patron or an operator
+            proper_noun_type: If hit_type is equivalent to 'proper noun', the type of proper noun
+        """
+        self.hits.append((hit_type, hit, context, patron_or_operator, proper_noun_type))
+
+    def hit_context(self, context):
+        """
+        Return the context of a hit as a string.
+        Parameters:
+            context: The context stored with the hit by add_hit()
+        """
+        if isinstance(context, int):
+            return self.line(context) + " "
+        return self.entity_text[context[0]:context[1]]
+
 def split_sentences(data):
     """
     Splits a body of text by lines, then again by words
     Parameters:
         data: A csv in python list form
     Returns:
-        data: A csv in python list form, where all text in column with index data_array_text_location split by lines and words
-    """
-    for i in range(len(data) - 1, -1, -1):
-        data[i][data_array_text_location] = data[i][data_array_text_location].split('\n')
-        for j in range(len(data[i][data_array_text_location]) - 1, -1, -1):
-            data[i][data_array_text_location][j] = (data[i][data_array_text_location][j]).split() #Replace each line with a list of its words
-            if data[i][data_array_text_location][j] == []: #Remove sentences with no words
-                data[i][data_array_text_location].pop(j)
-        #Add empty strings for return data
-        for j in range(5):
-            data[i].append([])
-    return data
+        data: A list containing a ChatLog for each row of the csv
+    """
+    return [ChatLog(row) for row in data]
 
-def line_to_string(line):
+def analyze_proper_nouns(data):
     """
-    Converts a list of words to a string containing its contents as a line
+    Find and analyze proper nouns using Spacy, given the whole data set
     Parameters:
-        line: A list where each object is a string containing a word
+        data: A list of ChatLog objects to analyze
     Returns:
-        output: A string containing each word in list seperated by a space
+        data: The list of ChatLog objects, with all proper noun hits added to each chat log
+    """
+    all_logs = [] #A list of every chat log
+    all_segments = [] #For each chat log, the offset where each message starts and who sent it
+    for chat_log in data: #Iterate over each chat log
+        parts = []
+        segment_starts = []
+        segment_speakers = []
+        length = 0
+        for j in range(chat_log.line_count() - 1, -1, -1): #Iterate over each line
+            words = chat_log.line(j).split(" ")
+            if len(words) > 2:
+                words = [word for word in words if "http" not in word.lower()] #Remove links
+                #Removing links may have changed the user data of this message, so attribute it again
+                if MODE == "jira":
+                    patron_or_op = "N/A"
+                else:
+                    patron_or_op = classify_speaker(chat_log, words) or (chat_log.speakers[j - 1] if j > 0 else "Unable to find")
+                line_string = " ".join(words[2:]) + " " if len(words) > 2 else ""
+                #Record where the message starts and whether it was sent by patron, operator, or neither
+                if "system message" not in line_string.lower():
+                    segment_starts.append(length)
+                    segment_speakers.append(patron_or_op if patron_or_op in ("Operator", "Patron") else "Unable to find")
+                    parts.append(line_string)
+                    length += len(line_string)
+        all_logs.append("".join(parts))
+        all_segments.append((segment_starts, segment_speakers))
+    entities = find_entities(all_logs)
+    for i in range(len(all_logs)):
+        line = all_logs[i]
+        segment_starts, segment_speakers = all_segments[i]
+        for start, end, label, context_start, context_end in entities[i]:
+            entity_text = line[start:end]
+            if label not in IGNORED_ENTITY_LABELS and entity_text.lower() != "librarian":
+                #Find the message the entity starts in
+                patron_or_op = segment_speakers[bisect.bisect_right(segment_starts, start) - 1]
+                #Add the proper noun, chat log, sentence context, and proper noun type to the database. The context is kept as offsets into the log, and only turned into a string when it is exported
+                data[i].entity_text = line
+                data[i].add_hit("Proper noun", sys.intern(entity_text.lower()), (context_start, context_end), patron_or_op, sys.intern(label))
+    return data
+
+#Entity labels that are not counted as proper nouns
+IGNORED_ENTITY_LABELS = ("CARDINAL", "ORDINAL", "QUANTITY", "MONEY", "PERCENT", "TIME", "DATE")
+
+def get_nlp():
     """
-    output = ""
-    for word in line:
-        for char in word:
-            output = output + char
-        output = output + " "
-    return output
+    Return the spaCy pipeline, loading it the first time this is called. Only the components needed for named entity recognition are loaded.
+    """
+    global nlp
+    if nlp is None:
+        import spacy
+        nlp = spacy.load(NER_MODEL, exclude=NER_EXCLUDED_COMPONENTS)
+        #The shared token-to-vector layer is only needed if the entity recognizer listens to it
+        if "tok2vec" in nlp.pipe_names and "ner" not in nlp.get_pipe("tok2vec").listening_components:
+            nlp.disable_pipe("tok2vec")
+    return nlp
 
-def append_hit_data(chat_log, hit_type, hit, hit_context, patron_or_operator, proper_noun_type=""):
+def get_model_name():
+    """
+    Return the name and version of the spaCy model, for example en_core_web_sm-3.0.0
+    The version is read from the metadata of the installed model package, so that the model does not have to be loaded. The model is only loaded if it is not installed as a package.
     """
-    Given a chat log and a hit, append all hit data to the chat log
+    try:
+        return NER_MODEL + "-" + importlib.metadata.version(NER_MODEL)
+    except importlib.metadata.PackageNotFoundError:
+        meta = get_nlp().meta
+        return meta["lang"] + "_" + meta["name"] + "-" + meta["version"]
+
+def get_entity_spans(doc):
+    """
+    Get the position of each named entity spaCy found in a document, along with the position of five words of context on either side.
     Parameters:
-        chat_log: A chat log list
-        hit_type: The string containing the type of hit
-        hit: The string containing the text found
-        hit_context: The string containing the message the hit was found in
-        patron_or_operator: The string containing whether the message was sent by a patron or an operator
-        proper_noun_type: If hit_type is equivalent to 'proper noun', the type of proper noun
+        doc: A spaCy Doc
     Returns:
-        chat_log: A chat log list with all hit data appended
+        A list containing a list for each entity in format [start, end, label, context start, context end], where each position is a character offset into the text of doc
     """
-    chat_log[len(chat_log) - 5].append(hit_type)
-    chat_log[len(chat_log) - 4].append(hit)
-    chat_log[len(chat_log) - 3].append(hit_context)
-    chat_log[len(chat_log) - 2].append(patron_or_operator)
-    chat_log[len(chat_log) - 1].append(proper_noun_type)
-    return chat_log
+    spans = []
+    for entity in doc.ents:
+        context = doc[entity.start - 5:entity.end + 5]
+        if len(context) == 0:
+            spans.append([entity.start_char, entity.end_char, entity.label_, 0, 0])
+        else:
+            spans.append([entity.start_char, entity.end_char, entity.label_, context.start_char, context.end_char])
+    return spans
 
-def analyze_proper_nouns(data):
+def find_entities(logs):
     """
-    Find and analyze proper nouns using Spacy, given the whole data set
+    Find the named entities in each log using spaCy. If entity_cache is set, logs found in the cache are not run through spaCy again.
     Parameters:
-        data: The list containing all data to analyze
+        logs: A list of strings, each containing a log to analyze
     Returns:
-        data: The list containing all data to analyze, with all hits appended to each chat log
+        A list containing the result of get_entity_spans() for each log
     """
-    all_logs = [] #A list of every chat log
-    for i in range(len(data)): #Iterate over each chat log
-        log = ""
-        for j in range(len(data[i][data_array_text_location]) - 1, -1, -1): #Iterate over each line
-            if len(data[i][data_array_text_location][j]) > 2:
-                for k in range(len(data[i][data_array_text_location][j]) - 1, -1, -1): #Iterate over each word
-                    if "http" in data[i][data_array_text_location][j][k].lower(): #Remove links
-                        data[i][data_array_text_location][j].pop(k)
-                patron_or_op = patron_or_operator(data[i], j)
-                line_string = line_to_string(data[i][data_array_text_location][j][2:])
-                #Mark whether sent by patron, operator, or neither
-                if "system message" not in line_string.lower():
-                    if patron_or_op == "Operator":
-                        log = log + "chat_operator:" + line_string
-                    elif patron_or_op == "Patron":
-                        log = log + "chat_patron:" + line_string
-                    else:
-                        log = log + "chat_neither:" + line_string
-        all_logs.append(log)
-    docs = nlp.pipe(all_logs, disable=["tagger, parser"])
-    i = 0
-    for line in docs:
-        for entity in line.ents:
-            if entity.label_ != "CARDINAL" and entity.label_ != "ORDINAL" and entity.label_ != "QUANTITY" and entity.label_ != "MONEY" and entity.label_ != "PERCENT" and entity.label_ != "TIME" and entity.label_ != "DATE" and entity.text.lower() != "librarian" and "chat_operator" not in entity.text.lower() and "chat_patron" not in entity.text.lower() and "chat_neither" not in entity.text.lower():
-                text = str(line[:entity.start])
-                #Use earlier marking to track patron, operator, or neither
-                oploc = text.rfind("chat_operator:")
-                paloc = text.rfind("chat_patron:")
-                neloc = text.rfind("chat_neither:")
-                if oploc > paloc and oploc > neloc:
-                    patron_or_op = "Operator"
-                elif paloc > oploc and paloc > neloc:
-                    patron_or_op = "Patron"
-                elif neloc > oploc and neloc > paloc:
-                    patron_or_op = "Unable to find"
-                else:
-                    patron_or_op = "Error"
-                #Add the proper noun, chat log, sentence context, and proper noun type to the database
-                data[i] = append_hit_data(data[i],"Proper noun",entity.text.lower(), str(line[entity.start - 5:entity.end + 5]), patron_or_op, entity.label_)
-        i += 1
-    return data
+    entities = [None] * len(logs)
+    if entity_cache:
+        keys = [entity_cache.key(log) for log in logs]
+        entities = entity_cache.get_many(keys)
+    missing = [i for i in range(len(logs)) if entities[i] is None]
+    start = time.perf_counter()
+    #spaCy is only loaded if there are logs that are not cached
+    if missing:
+        docs = get_nlp().pipe([logs[i] for i in missing], batch_size=ner_batch_size)
+        for i, doc in zip(missing, docs):
+            entities[i] = get_entity_spans(doc)
+    if metrics:
+        metrics.add_ner(len(missing), len(logs) - len(missing), math.ceil(len(missing) / ner_batch_size), time.perf_counter() - start)
+    if entity_cache:
+        entity_cache.put_many([(keys[i], entities[i]) for i in missing])
+    return entities
+
+class EntityCache:
+    """
+    An on-disk SQLite cache of the named entities spaCy finds in each log, so that logs analyzed in an earlier run are not run through spaCy again.
+    Entries are keyed by a hash of the log text and the name and version of the spaCy model. When the cache holds more than max_entries entries, the least recently used entries are removed.
+    Hit, miss and eviction counts are kept in the cache file, so they include lookups made by every worker process.
+    Parameters:
+        path: The file to store the cache in
+        max_entries: The greatest number of logs to keep entities for
+    """
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.model = None #The name and version of the spaCy model, set when the first key is made
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entities (key TEXT PRIMARY KEY, entities TEXT NOT NULL, last_used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entities_last_used ON entities (last_used)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.connection.executemany("INSERT OR IGNORE INTO stats VALUES (?, 0)", [("hits",), ("misses",), ("evictions",)])
+
+    def key(self, log):
+        """
+        Return the cache key of a log.
+        """
+        if self.model is None:
+            self.model = get_model_name()
+        return hashlib.sha256((self.model + "\n" + log).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Look up the entities of many logs at once.
+        Parameters:
+            keys: A list of keys from key()
+        Returns:
+            A list containing the cached entities for each key, or None if the key is not in the cache
+        """
+        found = {}
+        now = time.time()
+        with self.connection:
+            for i in range(0, len(keys), CACHE_QUERY_SIZE):
+                chunk = keys[i:i + CACHE_QUERY_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                for key, entities in self.connection.execute("SELECT key, entities FROM entities WHERE key IN (" + placeholders + ")", chunk):
+                    found[key] = json.loads(entities)
+                self.connection.execute("UPDATE entities SET last_used = ? WHERE key IN (" + placeholders + ")", [now] + chunk)
+            hits = sum(1 for key in keys if key in found)
+            self.add_stats(hits=hits, misses=len(keys) - hits)
+        return [found.get(key) for key in keys]
+
+    def put_many(self, items):
+        """
+        Store the entities of many logs at once, then remove the least recently used entries if the cache is over its size limit.
+        Parameters:
+            items: A list of (key, entities) tuples
+        """
+        if not items:
+            return
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?)", [(key, json.dumps(entities), now) for key, entities in items])
+            excess = self.connection.execute("SELECT COUNT(*) FROM entities").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute("DELETE FROM entities WHERE key IN (SELECT key FROM entities ORDER BY last_used LIMIT ?)", (excess,))
+                self.add_stats(evictions=excess)
+
+    def add_stats(self, **counts):
+        """
+        Add to the hit, miss and eviction counts stored in the cache.
+        """
+        self.connection.executemany("UPDATE stats SET value = value + ? WHERE name = ?", [(value, name) for name, value in counts.items()])
+
+    def get_stats(self):
+        """
+        Return a dict containing the number of entries in the cache and the total hit, miss and eviction counts.
+        """
+        stats = dict(self.connection.execute("SELECT name, value FROM stats"))
+        stats["entries"] = self.connection.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+        return stats
+
+    def close(self):
+        self.connection.close()
+
+#The greatest number of keys looked up in one query, below SQLite's limit on query parameters
+CACHE_QUERY_SIZE = 500
+#The EntityCache used by find_entities(), or None to always run spaCy
+entity_cache = None
 
 def initialize_query_return_data(terms):
     """
@@ -231,217 +557,1621 @@ def strip_punctuation(text):
         text = text[:-1]
     return text
 
-def query(chat_log, line, terms, chat_id, line_index):
+#Terms that are matched anywhere in a line rather than as whole words
+SUBSTRING_TERMS = ("Utsc.utoronto.ca", "Utoronto.ca")
+#Characters that make a term a regular expression rather than a literal
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+#Characters that may follow a term for it to count as a hit
+TERM_BOUNDARY_PATTERN = re.compile("[ .]")
+MASTERS_ABBREVIATION_PATTERN = re.compile(r" M\.{0,1}A(\n| )")
+MASTERS_PATTERN = re.compile(r" master'{0,1}s(\n| )")
+MSC_PATTERN = re.compile(r"(^| )((M\.{0,1}Sc)|(m\.{0,1}sc)|(M\.{0,1}sc))($| |\.)")
+FILE_EXTENSION_PATTERN = re.compile(r"[^/.]\.([a-z]{2,5})(?<!\.com)(?<!\.co)(?<!\.ca)(?<!\.org)(?<!\.or)(?<!\.net)(?<!\.ne)(?<!\.gov)(?<!\.go)(?<!\.edu)(?<!\.ed)(?<!\.html)(?<!\.htm)(?<!\.ht) ")
+#Course code: (^| )(([A-Za-z]{3}\d{3})|([A-Za-z]{3}(A|B|C|D|a|b|c|d)\d{2}))((H|Y|h|y)\d){0,1}
+COURSE_CODE_PATTERN = re.compile(r"(^| )(([A-Za-z]{3}\d{3})|([A-Za-z]{3}(A|B|C|D|a|b|c|d)\d{2}))((H|Y|h|y)\d){0,1}(f|s|y|F|S|Y){0,1}($| |\.)")
+#Substring rules for terms that need to be grouped together under one name, in the order they are checked
+GROUPED_TERM_RULES = (((" librar",), "Library"), ((" nvivo", " nvivohub"), "Nvivo"), ((" reference",), "Reference"), ((" citation",), "Citation"), ((" protocol",), "Library"), ((" grad ", " gradu"), "Graduate"))
+
+class TermMatcher:
+    """
+    Matches every query term and built-in rule against a line. Built once from the list of terms, so that the cost of querying a line depends on the length of the line rather than the number of terms.
+    Literal terms are indexed by their lowercase text and looked up at every word start in the line, for every possible end of a term (a space, a period or the end of the line).
+    Parameters:
+        terms: A list of strings, each containing a term to search for
+    """
+    def __init__(self, terms):
+        self.terms = terms
+        self.term_index = {} #Lowercase term -> positions of the term in terms
+        self.substring_terms = [] #(position, lowercase term) of terms matched anywhere in a line
+        self.pattern_terms = [] #(position, compiled pattern) of terms containing regular expression syntax
+        self.max_term_length = 0
+        for position, term in enumerate(terms):
+            lower = term.lower()
+            if term in SUBSTRING_TERMS:
+                self.substring_terms.append((position, lower))
+            elif REGEX_METACHARACTERS.intersection(lower):
+                self.pattern_terms.append((position, re.compile("(^| )" + lower + r"($| |\.)")))
+            else:
+                self.term_index.setdefault(lower, []).append(position)
+                self.max_term_length = max(self.max_term_length, len(lower))
+        #Each query rule is a (name, function) tuple, where the function takes the line and the lowercase line and returns a list of (hit type, hit) tuples
+        self.rules = [("Query terms", self.find_query_terms)]
+        for substrings, name in GROUPED_TERM_RULES:
+            self.rules.append((name + " (" + ", ".join('"' + substring + '"' for substring in substrings) + ")", functools.partial(find_grouped_term, substrings, name)))
+        self.rules.append(("Master's", find_masters))
+        self.rules.append(("MSC", find_msc))
+        self.rules.append(("File Extension", find_file_extension))
+        self.rules.append(("Course Code", find_course_code))
+
+    def find_terms(self, lower):
+        """
+        Find every term that occurs in a line.
+        Parameters:
+            lower: The lowercase line to search
+        Returns:
+            A list of each term found, in the order of the list of terms. Each term is listed once for each time it appears in the list of terms.
+        """
+        found = set()
+        for position, term in self.substring_terms:
+            if metrics:
+                start = time.perf_counter()
+                matched = term in lower
+                metrics.add_rule("Query term: " + self.terms[position], time.perf_counter() - start, int(matched))
+            else:
+                matched = term in lower
+            if matched:
+                found.add(position)
+        for position, pattern in self.pattern_terms:
+            if metrics:
+                start = time.perf_counter()
+                matched = pattern.search(lower)
+                metrics.add_rule("Query term: " + self.terms[position], time.perf_counter() - start, int(bool(matched)))
+            else:
+                matched = pattern.search(lower)
+            if matched:
+                found.add(position)
+        if self.term_index:
+            if metrics:
+                index_start = time.perf_counter()
+                index_found = len(found)
+            boundaries = [match.start() for match in TERM_BOUNDARY_PATTERN.finditer(lower)]
+            #A term can start at the beginning of the line or after any space
+            starts = [0] + [boundary + 1 for boundary in boundaries if lower[boundary] == " "]
+            boundaries.append(len(lower))
+            for start in starts:
+                i = bisect.bisect_right(boundaries, start)
+                while i < len(boundaries) and boundaries[i] - start <= self.max_term_length:
+                    positions = self.term_index.get(lower[start:boundaries[i]])
+                    if positions:
+                        found.update(positions)
+                    i += 1
+            if metrics:
+                metrics.add_rule("Query term index", time.perf_counter() - index_start, len(found) - index_found)
+        return [self.terms[position] for position in sorted(found)]
+
+    def find_query_terms(self, line_string, lower):
+        """
+        Query rule for the terms in the list of terms.
+        """
+        return [("Query term", term) for term in self.find_terms(lower)]
+
+    def query(self, line_string, lower):
+        """
+        Run every query rule against a line.
+        Parameters:
+            line_string: The string containing the whole line
+            lower: The lowercase line, with user data removed if in ask chat mode
+        Returns:
+            A list of (hit type, hit) tuples, in the order the rules are checked
+        """
+        hits = []
+        if metrics:
+            for name, rule in self.rules:
+                start = time.perf_counter()
+                rule_hits = rule(line_string, lower)
+                metrics.add_rule(name, time.perf_counter() - start, len(rule_hits))
+                hits.extend(rule_hits)
+        else:
+            for name, rule in self.rules:
+                hits.extend(rule(line_string, lower))
+        return hits
+
+    def query_user_data(self, user_data):
+        """
+        Check whether the user data at the start of an ask chat line has a hit for any query rule that searches the whole line.
+        Since no rule can match across a space, except at the start or end of a match, user data with no hits does not change the hits of the rest of the line.
+        Parameters:
+            user_data: The time and user name at the start of the line, followed by a space
+        Returns:
+            True if any rule finds a hit in user_data
+        """
+        return any(rule(user_data, "") for name, rule in self.rules if rule != self.find_query_terms)
+
+#Returned by query rules that find nothing
+NO_HITS = ()
+
+def find_grouped_term(substrings, name, line_string, lower):
     """
-    Perform required querying tasks on a chat log
+    Query rule for a term that needs to be grouped together under one name. Use with functools.partial() to set substrings and name.
     Parameters:
-        chat_log: A chat log list
-        line: A list where each object is a string containing a word
-        terms: A list of terms to query
-        chat_id: The identification number of the chat log
+        substrings: A tuple of strings, any of which counts as a hit
+        name: The name to report the hit as
+    """
+    for substring in substrings:
+        if substring in lower:
+            return [("Query term", name)]
+    return NO_HITS
+
+def find_masters(line_string, lower):
+    """
+    Query rule to check if master's is mentioned.
+    """
+    if MASTERS_ABBREVIATION_PATTERN.search(line_string) or MASTERS_PATTERN.search(lower):
+        return [("Query term", "Master's")]
+    return NO_HITS
+
+def find_msc(line_string, lower):
+    """
+    Query rule to check if MSC is mentioned.
+    """
+    if MSC_PATTERN.search(line_string):
+        return [("Query term", "MSC")]
+    return NO_HITS
+
+def find_file_extension(line_string, lower):
+    """
+    Query rule to check if there is a file extension.
+    """
+    file_extension_match = FILE_EXTENSION_PATTERN.search(line_string)
+    if file_extension_match:
+        return [("File Extension", file_extension_match.group()[1:-1])]
+    return NO_HITS
+
+def find_course_code(line_string, lower):
+    """
+    Query rule to check if there is a course code.
+    """
+    course_code_match = COURSE_CODE_PATTERN.search(line_string)
+    if course_code_match:
+        return [("Course Code", strip_punctuation(course_code_match.group()))]
+    return NO_HITS
+
+def query(chat_log, line_index, matcher):
+    """
+    Perform required querying tasks on a line of a chat log
+    Parameters:
+        chat_log: A ChatLog
         line_index: The index of the message to be observed in the chat log
+        matcher: A TermMatcher built from the terms to query
     Returns:
-        chat_log: A chat log list with all query data appended
+        chat_log: The ChatLog with all query hits for the line added
     """
-    line_string = line_to_string(line)
+    line_string = chat_log.line(line_index) + " "
     #Remove user data if in ask chat mode
-    trimmed_line_string = line_to_string(line[2:]) if MODE == "ask_chat" else line_string
+    if MODE == "ask_chat":
+        words = line_string.split(" ", 2)
+        trimmed_line_string = words[2] if len(words) > 2 else ""
+    else:
+        trimmed_line_string = line_string
     lower = trimmed_line_string.lower()
     #Ignore most common system messages
     if "System message:" not in line_string and "ask a librarian" not in lower:
-        #Check for terms
-        for term in terms:
-            if term != "Utsc.utoronto.ca" and term != "Utoronto.ca":
-                term_search = re.search("(^| )" + term.lower() + "($| |\.)", lower )
-                if term_search:
-                    chat_log = append_hit_data(chat_log,"Query term",term,line_string, patron_or_operator(chat_log, line_index))
-            elif term.lower() in lower:
-                chat_log = append_hit_data(chat_log,"Query term",term,line_string, patron_or_operator(chat_log, line_index))
-        #Check for with specific requirements or terms that need to be grouped together under one name
-        if " librar" in lower:
-            chat_log = append_hit_data(chat_log,"Query term","Library",line_string, patron_or_operator(chat_log, line_index))
-        if " nvivo" in lower or " nvivohub" in lower:
-            chat_log = append_hit_data(chat_log,"Query term","Nvivo",line_string, patron_or_operator(chat_log, line_index))
-        if " reference" in lower:
-            chat_log = append_hit_data(chat_log,"Query term","Reference",line_string, patron_or_operator(chat_log, line_index))
-        if " citation" in lower:
-            chat_log = append_hit_data(chat_log,"Query term","Citation",line_string, patron_or_operator(chat_log, line_index))
-        if " protocol" in lower:
-            chat_log = append_hit_data(chat_log,"Query term","Library",line_string, patron_or_operator(chat_log, line_index))
-        #Check if a form of the word "Graduate" is in the line - but it isn't a form of "undergraduate" or "graduated"
-        if " grad " in lower or " gradu" in lower:
-            chat_log = append_hit_data(chat_log,"Query term","Graduate",line_string, patron_or_operator(chat_log, line_index))
-        #Check if master's is mentioned
-        if re.search(" M\.{0,1}A(\n| )", line_string) or re.search(" master'{0,1}s(\n| )",lower):
-            chat_log = append_hit_data(chat_log,"Query term","Master's",line_string, patron_or_operator(chat_log, line_index))
-        #Check if MSC is mentioned
-        if re.search("(^| )((M\.{0,1}Sc)|(m\.{0,1}sc)|(M\.{0,1}sc))($| |\.)", line_string):
-            chat_log = append_hit_data(chat_log,"Query term","MSC",line_string, patron_or_operator(chat_log, line_index))
-        #Check if there is a file extension
-        file_extension_match = re.search("[^/.]\.([a-z]{2,5})(?<!\.com)(?<!\.co)(?<!\.ca)(?<!\.org)(?<!\.or)(?<!\.net)(?<!\.ne)(?<!\.gov)(?<!\.go)(?<!\.edu)(?<!\.ed)(?<!\.html)(?<!\.htm)(?<!\.ht) ", line_string)
-        if file_extension_match:
-            chat_log = append_hit_data(chat_log,"File Extension",file_extension_match.group()[1:-1],line_string, patron_or_operator(chat_log, line_index))
-        #Check if course code(^| )(([A-Za-z]{3}\d{3})|([A-Za-z]{3}(A|B|C|D|a|b|c|d)\d{2}))((H|Y|h|y)\d){0,1}
-        course_code_match = re.search("(^| )(([A-Za-z]{3}\d{3})|([A-Za-z]{3}(A|B|C|D|a|b|c|d)\d{2}))((H|Y|h|y)\d){0,1}(f|s|y|F|S|Y){0,1}($| |\.)", line_string)
-        if course_code_match:
-            chat_log = append_hit_data(chat_log,"Course Code",strip_punctuation(course_code_match.group()),line_string, patron_or_operator(chat_log, line_index))
+        if query_cache:
+            hits = query_cache.query(matcher, line_string, trimmed_line_string, lower)
+        else:
+            hits = matcher.query(line_string, lower)
+        for hit_type, hit in hits:
+            chat_log.add_hit(hit_type, hit, line_index, chat_log.speakers[line_index])
+            if metrics and hit_type == "Query term":
+                metrics.add_term_hit(hit)
     return chat_log
 
-def iterate_query(data, terms):
+class QueryCache:
+    """
+    An in-memory cache of the query hits of each line, so that lines repeated word for word across chats, such as canned greetings, queue transfer notices and signatures, are only queried once. Speakers and contexts are still worked out for each line.
+    Lines are keyed by their text with the user data removed in ask chat mode. The key keeps the case of the line, since some rules, such as course codes and MSc, are case sensitive.
+    The time and user name at the start of an ask chat line are not part of the key, so lines whose user data has a hit for a rule that searches the whole line are always queried and not cached.
+    When the cache holds more than max_entries lines, the least recently used lines are removed.
+    Parameters:
+        max_entries: The greatest number of lines to keep hits for
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict() #Line -> list of (hit type, hit) tuples
+        self.user_data = {} #User data -> whether it has a hit, see TermMatcher.query_user_data()
+        self.stats = collections.Counter() #Number of hits, misses, evictions and uncached lines
+
+    def query(self, matcher, line_string, trimmed_line_string, lower):
+        """
+        Return the hits of matcher.query() for a line, from the cache if the line has been queried before.
+        Parameters:
+            matcher: A TermMatcher built from the terms to query
+            line_string: The string containing the whole line
+            trimmed_line_string: The line with user data removed if in ask chat mode
+            lower: The lowercase trimmed line
+        """
+        user_data = line_string[:len(line_string) - len(trimmed_line_string)]
+        if user_data:
+            has_hit = self.user_data.get(user_data)
+            if has_hit is None:
+                if len(self.user_data) >= self.max_entries:
+                    self.user_data.clear()
+                has_hit = self.user_data[user_data] = matcher.query_user_data(user_data)
+            if has_hit:
+                self.stats["uncached"] += 1
+                return matcher.query(line_string, lower)
+        hits = self.entries.get(trimmed_line_string)
+        if hits is not None:
+            self.entries.move_to_end(trimmed_line_string)
+            self.stats["hits"] += 1
+            return hits
+        self.stats["misses"] += 1
+        hits = matcher.query(line_string, lower) or NO_HITS
+        self.entries[trimmed_line_string] = hits
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return hits
+
+    def get_stats(self):
+        """
+        Return a dict containing the number of hits, misses, evictions and uncached lines, and the hit rate.
+        """
+        stats = {name: self.stats[name] for name in ("hits", "misses", "evictions", "uncached")}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+        return stats
+
+#The QueryCache used by query(), or None to query every line
+query_cache = None
+
+def iterate_query(data, matcher):
     """
     Perform required querying tasks iteratively.
     Parameters:
-        data: The list containing all data to analyze
-        terms: A list of terms to query
+        data: A list of ChatLog objects to analyze
+        matcher: A TermMatcher built from the terms to query
     Returns:
-        data: The list containing all data to analyze, with all chat logs queried and added as hits
+        data: The list of ChatLog objects, with all query hits added to each chat log
     """
-    for i in range(len(data)): #Iterate over each chat log
-        for j in range(len(data[i][data_array_text_location])): #Iterate over each line
-            if len(data[i][data_array_text_location][j]) > 1:
+    for chat_log in data: #Iterate over each chat log
+        for j in range(chat_log.line_count()): #Iterate over each line
+            if " " in chat_log.line(j):
                 #Perform sentence queries
-                data[i] = query(data[i], data[i][data_array_text_location][j], terms, data[i][0], j)
+                query(chat_log, j, matcher)
     return data
 
-def export_csv(data, headers, name):
+ASK_CHAT_EXPORT_HEADERS = ["id", "guest", "protocol", "queue", "profile", "started", "wait", "duration", "referrer", "referrer domain", "Operator Institution", "UofT Operator Role", "UofT Operator Campus", "Redacted?", "Notes", "Hit Type", "Hit", "Hit Context", "Sent by", "Proper noun classification"]
+#Columns of a JIRA file that are copied to the export, in order
+JIRA_EXPORT_COLUMNS = ("Summary", "Issue key", "Issue id", "Issue Type", "Status", "Project key", "Project name", "Project type", "Project url", "Priority", "Resolution", "Created", "Updated", "Last Viewed", "Resolved")
+JIRA_EXPORT_HEADERS = ["Summary", "Issue key", "Issue id", "Issue Type", "Status", "Project key", "Project name", "Project type", "Project url", "Priority", "Resolution", "Created", "Updated", "Last Viewed", "Resolved", "Redacted?", "Notes", "Hit Type", "Hit", "Hit Context", "Proper noun classification"]
+#The column of the export that holds the id of each chat or ticket. In a .csv export it is only filled in on the first row of each chat or ticket.
+EXPORT_ID_COLUMN = {"ask_chat": 0, "jira": 2}
+#The hit columns of the row exported for an ask chat with no hits
+NO_HIT_COLUMNS = ["No hit!", "", "", "", ""]
+#The size in bytes of the buffer used when writing an export
+EXPORT_BUFFER_SIZE = 1024 * 1024
+#Export formats, by the extension of the export file. Files with any other extension are exported as .csv
+EXPORT_FORMATS = {".csv": "csv", ".parquet": "parquet", ".db": "sqlite", ".sqlite": "sqlite", ".sqlite3": "sqlite"}
+#Columns of a Parquet export that are dictionary encoded, since they have few distinct values
+PARQUET_DICTIONARY_COLUMNS = ("protocol", "queue", "profile", "referrer domain", "Operator Institution", "UofT Operator Role", "UofT Operator Campus", "Issue Type", "Status", "Project key", "Project name", "Project type", "Project url", "Priority", "Resolution", "Hit Type", "Hit", "Sent by", "Proper noun classification")
+#The number of rows in each row group of a Parquet export
+PARQUET_ROW_GROUP_SIZE = 100000
+#The number of rows inserted into an SQLite export at a time
+SQLITE_EXPORT_BATCH_SIZE = 10000
+
+def get_export_headers():
+    """
+    Return the column headers of the export for the current mode.
+    """
+    if MODE == "jira":
+        return JIRA_EXPORT_HEADERS
+    return ASK_CHAT_EXPORT_HEADERS
+
+def get_export_format(filename, export_format=None):
     """
-    Export relevant data in a .csv format. Remove any data that may contain private information.
+    Return the format to export as: export_format if it is given, otherwise the format matching the extension of filename.
+    Parameters:
+        filename: The filename to export as
+        export_format: csv, parquet or sqlite, or None
+    """
+    if export_format:
+        return export_format
+    return EXPORT_FORMATS.get(os.path.splitext(filename)[1].lower(), "csv")
+
+def open_export(filename, export_format=None):
+    """
+    Create an export file and write its headers. If export_summary is set, summary tables are written next to it, and if export_hits is not set, only the summary tables are written.
+    Parameters:
+        filename: The filename to export as
+        export_format: csv, parquet or sqlite, or None to choose by the extension of filename
+    Returns:
+        A CSVExport, ParquetExport, SQLiteExport or SummaryExport, or an ExportGroup of several. Hits are added with its write() method, and the files are finished by its close() method.
+    """
+    exports = []
+    if export_hits:
+        export_format = get_export_format(filename, export_format)
+        if export_format == "parquet":
+            exports.append(ParquetExport(filename))
+        elif export_format == "sqlite":
+            exports.append(SQLiteExport(filename))
+        else:
+            exports.append(CSVExport(filename))
+    if export_summary:
+        exports.append(SummaryExport(filename))
+    return exports[0] if len(exports) == 1 else ExportGroup(exports)
+
+def export_csv(data, headers, name, export_format=None):
+    """
+    Export relevant data in a .csv format, or as a Parquet file or SQLite database. Remove any data that may contain private information.
     Paramters:
         data: The list containing all data to analyze
         headers: A list of all column headers
         name: The filename to export as
+        export_format: csv, parquet or sqlite, or None to choose by the extension of name
     """
-    with open(name, 'w') as csvfile:
-        writer = csv.writer(csvfile)
+    export = open_export(name, export_format)
+    try:
+        with measure("export", rows=len(data)):
+            export.write(data, headers)
+    finally:
+        export.close()
 
+def write_export_headers(writer):
+    """
+    Write the column headers of the export for the current mode.
+    Parameters:
+        writer: A csv writer for the export file
+    """
+    writer.writerow(get_export_headers())
+
+def get_column_locations(headers, columns):
+    """
+    Return the index of each column in headers. The result is remembered for each set of headers, so it is only looked up once per file.
+    Parameters:
+        headers: A list containing the name of each column header of a file
+        columns: A tuple containing the names of the columns to find
+    """
+    key = (tuple(headers), columns)
+    if key not in column_locations:
+        column_locations[key] = [headers.index(column) for column in columns]
+    return column_locations[key]
+
+#Results of get_column_locations()
+column_locations = {}
+
+def get_export_metadata(chat_log, headers, names):
+    """
+    Return the export columns of a chat or ticket that come before its hit columns, up to and including Notes. Remove any data that may contain private information.
+    Parameters:
+        chat_log: An analyzed ChatLog
+        headers: A list of all column headers
+        names: The operator directory from load_operator_directory(), used in ask chat mode
+    """
+    if MODE == "ask_chat":
+        metadata = chat_log.row[:]
+        metadata.pop(11) #Remove text
+        metadata.pop(9) #Remove ip
+        metadata.pop(8) #Remove operator
+        #Chats with no hits are exported without operator data
+        if len(chat_log.hits) == 0:
+            return metadata + ["", "", "", "", "", ""]
+        #Add operator data
+        operator_data = get_operator_data(chat_log.row[8], names)
+        return metadata + [get_referrer_domain(chat_log.row[10]), get_operator_institution(chat_log.row[8]), operator_data[0], operator_data[1], "", ""]
+    locations = get_column_locations(headers, JIRA_EXPORT_COLUMNS)
+    return [chat_log.row[location] for location in locations] + ["", ""]
+
+def get_export_rows(chat_log, headers, names):
+    """
+    Return the export rows of a chat or ticket, one for each hit, each with the id of the chat or ticket.
+    If there are no hits for a chat, it has one row containing all metadata for that chat. A JIRA ticket with no hits has no rows.
+    Metadata that is the same for every hit of a chat is only worked out once per chat.
+    Parameters:
+        chat_log: An analyzed ChatLog
+        headers: A list of all column headers
+        names: The operator directory from load_operator_directory(), used in ask chat mode
+    """
+    if len(chat_log.hits) == 0:
         if MODE == "ask_chat":
-            writer.writerow(["id", "guest", "protocol", "queue", "profile", "started", "wait", "duration", "referrer", "referrer domain", "Operator Institution", "UofT Operator Role", "UofT Operator Campus", "Redacted?", "Notes", "Hit Type", "Hit", "Hit Context", "Sent by", "Proper noun classification"])
-            names = convertcsv("names.csv")[0]
-            for chat_log in data:
-                #If there are no hits for a chat, just output one row containing all metadata for that chat
-                if len(chat_log[len(chat_log) - 5]) == 0:
-                    row = chat_log[:len(chat_log) - 5]
-                    row.pop(11) #Remove text
-                    row.pop(9) #Remove ip
-                    row.pop(8) #Remove operator
-                    for i in range(6):
-                        row.append("")
-                    row.append("No hit!")
-                    for i in range(4):
-                        row.append("")
-                    writer.writerow(row)
+            return [get_export_metadata(chat_log, headers, names) + NO_HIT_COLUMNS]
+        return []
+    metadata = get_export_metadata(chat_log, headers, names)
+    if MODE == "ask_chat":
+        return [metadata + [hit_type, hit, chat_log.hit_context(context), patron_or_operator, proper_noun_type] for hit_type, hit, context, patron_or_operator, proper_noun_type in chat_log.hits]
+    return [metadata + [hit_type, hit, chat_log.hit_context(context), proper_noun_type] for hit_type, hit, context, patron_or_operator, proper_noun_type in chat_log.hits]
+
+def write_export_rows(writer, data, headers, names):
+    """
+    Write one export row for each hit in data. Remove any data that may contain private information.
+    Parameters:
+        writer: A csv writer for the export file
+        data: A list of analyzed ChatLog objects to export
+        headers: A list of all column headers
+        names: The operator directory from load_operator_directory(), used in ask chat mode
+    """
+    id_column = EXPORT_ID_COLUMN[MODE]
+    for chat_log in data:
+        rows = get_export_rows(chat_log, headers, names)
+        #Remove id if not a unique log, so we can differentiate between unique logs easily
+        for row in rows[1:]:
+            row[id_column] = ""
+        writer.writerows(rows)
+
+class CSVExport:
+    """
+    A .csv export, with one row for each hit.
+    Parameters:
+        filename: The filename to export as
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'w', buffering=EXPORT_BUFFER_SIZE)
+        self.writer = csv.writer(self.file)
+        write_export_headers(self.writer)
+        self.names = load_operator_directory("names.csv") if MODE == "ask_chat" else None
+
+    def write(self, data, headers):
+        """
+        Export the hits of a list of analyzed ChatLog objects.
+        Parameters:
+            data: A list of analyzed ChatLog objects to export
+            headers: A list of all column headers of the file data was read from
+        """
+        write_export_rows(self.writer, data, headers, self.names)
+
+    def close(self):
+        self.file.close()
+
+class ParquetExport:
+    """
+    A Parquet export, with the same columns as a .csv export and one row for each hit. Unlike a .csv export, every row has the id of its chat or ticket.
+    Hit types, hits and other columns with few distinct values are dictionary encoded, so they are stored once per row group and load as categories. Requires pyarrow.
+    Parameters:
+        filename: The filename to export as
+    """
+    def __init__(self, filename):
+        import pyarrow, pyarrow.parquet
+        self.pyarrow = pyarrow
+        headers = get_export_headers()
+        self.dictionary_columns = [header in PARQUET_DICTIONARY_COLUMNS for header in headers]
+        self.schema = pyarrow.schema([(header, pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if dictionary else pyarrow.string()) for header, dictionary in zip(headers, self.dictionary_columns)])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.names = load_operator_directory("names.csv") if MODE == "ask_chat" else None
+        self.rows = []
+
+    def write(self, data, headers):
+        """
+        Export the hits of a list of analyzed ChatLog objects. Rows are written a row group at a time.
+        Parameters:
+            data: A list of analyzed ChatLog objects to export
+            headers: A list of all column headers of the file data was read from
+        """
+        for chat_log in data:
+            self.rows.extend(get_export_rows(chat_log, headers, self.names))
+            if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the rows added since the last flush as a row group.
+        """
+        if not self.rows:
+            return
+        arrays = []
+        for column, dictionary in zip(zip(*self.rows), self.dictionary_columns):
+            array = self.pyarrow.array(column, type=self.pyarrow.string())
+            arrays.append(array.dictionary_encode() if dictionary else array)
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+class SQLiteExport:
+    """
+    An SQLite export, normalized into three tables so that chat metadata and lines are stored once:
+        chats: One row for each chat or ticket, including those with no hits, with the columns of a .csv export up to and including Notes. Chats are numbered in the order they are exported, in the chat column.
+        lines: One row for each line with a query hit, with the chat it belongs to, the index of the line in the chat and its text as it appears in the Hit Context column of a .csv export.
+        hits: One row for each hit, with its chat, hit type, hit, who sent it and proper noun type. Query hits refer to their line in the line column. Proper nouns have no line, and keep their context in the context column.
+    The hit_rows view joins the tables back into one row for each hit. Rows are inserted in batches in one transaction, and the indexes are created once every row is inserted.
+    Parameters:
+        filename: The filename to export as. An existing file is replaced.
+    """
+    def __init__(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.connection = sqlite3.connect(filename)
+        #The database is built from scratch, so it does not need to survive a crash part way through
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        headers = get_export_headers()
+        columns = [get_sql_column_name(header) for header in headers[:headers.index("Hit Type")]]
+        self.connection.execute("CREATE TABLE chats (chat INTEGER PRIMARY KEY, " + ", ".join(column + " TEXT" for column in columns) + ")")
+        self.connection.execute("CREATE TABLE lines (line INTEGER PRIMARY KEY, chat INTEGER NOT NULL REFERENCES chats, line_index INTEGER NOT NULL, text TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE hits (chat INTEGER NOT NULL REFERENCES chats, line INTEGER REFERENCES lines, hit_type TEXT NOT NULL, hit TEXT NOT NULL, context TEXT, sent_by TEXT, proper_noun_type TEXT)")
+        self.connection.execute("CREATE VIEW hit_rows AS SELECT chats.*, hit_type, hit, COALESCE(lines.text, hits.context) AS context, sent_by, proper_noun_type FROM hits JOIN chats ON chats.chat = hits.chat LEFT JOIN lines ON lines.line = hits.line")
+        self.insert_chat = "INSERT INTO chats VALUES (" + ", ".join("?" * (len(columns) + 1)) + ")"
+        self.names = load_operator_directory("names.csv") if MODE == "ask_chat" else None
+        self.chat_count = 0
+        self.line_count = 0
+        self.chats = []
+        self.lines = []
+        self.hits = []
+
+    def write(self, data, headers):
+        """
+        Export a list of analyzed ChatLog objects and their hits.
+        Parameters:
+            data: A list of analyzed ChatLog objects to export
+            headers: A list of all column headers of the file data was read from
+        """
+        for chat_log in data:
+            self.chat_count += 1
+            chat = self.chat_count
+            self.chats.append([chat] + get_export_metadata(chat_log, headers, self.names))
+            lines = {} #Line index -> line number, for lines of this chat that have been added
+            for hit_type, hit, context, patron_or_operator, proper_noun_type in chat_log.hits:
+                if isinstance(context, int):
+                    line = lines.get(context)
+                    if line is None:
+                        self.line_count += 1
+                        line = lines[context] = self.line_count
+                        self.lines.append((line, chat, context, chat_log.hit_context(context)))
+                    self.hits.append((chat, line, hit_type, hit, None, patron_or_operator, proper_noun_type or None))
+                else:
+                    self.hits.append((chat, None, hit_type, hit, chat_log.hit_context(context), patron_or_operator, proper_noun_type or None))
+            if len(self.chats) + len(self.hits) >= SQLITE_EXPORT_BATCH_SIZE:
+                self.flush()
+
+    def flush(self):
+        """
+        Insert the chats, lines and hits added since the last flush.
+        """
+        self.connection.executemany(self.insert_chat, self.chats)
+        self.connection.executemany("INSERT INTO lines VALUES (?, ?, ?, ?)", self.lines)
+        self.connection.executemany("INSERT INTO hits VALUES (?, ?, ?, ?, ?, ?, ?)", self.hits)
+        self.chats = []
+        self.lines = []
+        self.hits = []
+
+    def close(self):
+        self.flush()
+        self.connection.commit()
+        self.connection.executescript("""
+            CREATE INDEX hits_chat ON hits (chat);
+            CREATE INDEX hits_hit_type ON hits (hit_type);
+            CREATE INDEX hits_hit ON hits (hit);
+            CREATE INDEX hits_sent_by ON hits (sent_by);
+            CREATE INDEX lines_chat ON lines (chat);
+        """)
+        self.connection.close()
+
+def get_sql_column_name(header):
+    """
+    Return an export column header as an SQL column name, in lowercase with words separated by underscores.
+    For example, get_sql_column_name('UofT Operator Role') -> 'uoft_operator_role'
+    """
+    return re.sub(r"\W+", "_", header.lower()).strip("_")
+
+class ExportGroup:
+    """
+    Several exports written from the same hits, such as a .csv export and its summary tables.
+    Parameters:
+        exports: A list of exports from open_export()
+    """
+    def __init__(self, exports):
+        self.exports = exports
+
+    def write(self, data, headers):
+        for export in self.exports:
+            export.write(data, headers)
+
+    def close(self):
+        for export in self.exports:
+            export.close()
+
+#Summary tables of hits by a property of their chat or ticket, for each mode. Each table has a name and the column headers of its group, which are worked out by get_summary_groups().
+SUMMARY_TABLES = {
+    "ask_chat": (("queue", ("queue",)), ("month", ("month started",)), ("operator", ("UofT Operator Role", "UofT Operator Campus"))),
+    "jira": (("project", ("Project key",)), ("month", ("month created",)), ("issue_type", ("Issue Type",)))
+}
+MONTH_NAMES = {"jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6, "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12}
+ISO_MONTH_PATTERN = re.compile(r"^\s*(\d{4})-(\d{1,2})")
+JIRA_MONTH_PATTERN = re.compile(r"^\s*\d{1,2}/([A-Za-z]{3})/(\d{2,4})")
+
+def get_month(date):
+    """
+    Return the year and month of a date in format YYYY-MM, or an empty string if the format of the date is not known.
+    Ask Chat dates look like 2021-03-01 12:00:00 and JIRA dates look like 01/Mar/21 12:00 PM.
+    For example, get_month('01/Mar/21 12:00 PM') -> '2021-03'
+    """
+    match = ISO_MONTH_PATTERN.match(date)
+    if match:
+        return match.group(1) + "-" + match.group(2).zfill(2)
+    match = JIRA_MONTH_PATTERN.match(date)
+    if match and match.group(1).lower() in MONTH_NAMES:
+        year = match.group(2)
+        if len(year) == 2:
+            year = "20" + year
+        return year + "-" + str(MONTH_NAMES[match.group(1).lower()]).zfill(2)
+    return ""
+
+def get_summary_groups(chat_log, headers, names):
+    """
+    Return the group of a chat or ticket in each summary table in SUMMARY_TABLES, as a tuple of column values.
+    Parameters:
+        chat_log: An analyzed ChatLog
+        headers: A list of all column headers of the file the chat was read from
+        names: The operator directory from load_operator_directory(), used in ask chat mode
+    """
+    row = chat_log.row
+    if MODE == "ask_chat":
+        queue, started = get_column_locations(headers, ("queue", "started"))
+        operator_data = get_operator_data(row[8], names)
+        return ((row[queue],), (get_month(row[started]),), (operator_data[0], operator_data[1]))
+    project, created, issue_type = get_column_locations(headers, ("Project key", "Created", "Issue Type"))
+    return ((row[project],), (get_month(row[created]),), (row[issue_type],))
+
+def count_pairs(groups, terms, term_count):
+    """
+    Count how many times each pair of a group and a term occurs. Uses NumPy if it is installed.
+    Parameters:
+        groups: An array.array of the group code of each hit
+        terms: An array.array of the term code of each hit, the same length as groups
+        term_count: The number of distinct term codes
+    Returns:
+        A list of (group code, term code, count) tuples
+    """
+    if numpy is None:
+        return [(group, term, count) for (group, term), count in collections.Counter(zip(groups, terms)).items()]
+    #Combine each pair into one integer, so pairs are counted by one sort
+    keys = numpy.asarray(groups, dtype=numpy.int64) * term_count + numpy.asarray(terms, dtype=numpy.int64)
+    keys, counts = numpy.unique(keys, return_counts=True)
+    return list(zip((keys // term_count).tolist(), (keys % term_count).tolist(), counts.tolist()))
+
+class SummaryExport:
+    """
+    Summary tables of the number of hits of each term, written next to the export as .csv files named after it, with _summary_<table> added before the extension:
+        terms: The number of hits of each term, and the number of chats or tickets it was found in
+        One table for each entry in SUMMARY_TABLES, with the number of hits of each term in each group, for example by queue or by the month a chat started
+        speaker: In ask chat mode, the number of hits of each term sent by patrons and by operators
+    Terms are the pair of a hit type and a hit. Each term, group and speaker is given an integer code as hits are added, and only the codes of each hit are kept. The tables are counted over arrays of codes once every hit is added, with NumPy if it is installed.
+    Parameters:
+        filename: The filename of the export the summary tables are named after
+    """
+    def __init__(self, filename):
+        base, extension = os.path.splitext(filename)
+        self.filename = base + "_summary_{}" + (extension if extension == ".csv" else ".csv")
+        self.names = load_operator_directory("names.csv") if MODE == "ask_chat" else None
+        self.tables = SUMMARY_TABLES[MODE]
+        self.term_codes = {} #(hit type, hit) -> code
+        self.group_codes = [{} for table in self.tables] #Group of each table -> code
+        self.speaker_codes = {} #Sent by -> code
+        self.chat_groups = [array.array("I") for table in self.tables] #The group code of each chat in each table
+        self.hit_chats = array.array("I") #The index of the chat of each hit
+        self.hit_terms = array.array("I") #The term code of each hit
+        self.hit_speakers = array.array("I") #The speaker code of each hit
+        self.chat_count = 0
+
+    def write(self, data, headers):
+        """
+        Add the hits of a list of analyzed ChatLog objects to the summary.
+        Parameters:
+            data: A list of analyzed ChatLog objects
+            headers: A list of all column headers of the file data was read from
+        """
+        term_codes = self.term_codes
+        speaker_codes = self.speaker_codes
+        for chat_log in data:
+            if len(chat_log.hits) == 0:
+                continue
+            chat = self.chat_count
+            self.chat_count += 1
+            for group, codes, chat_groups in zip(get_summary_groups(chat_log, headers, self.names), self.group_codes, self.chat_groups):
+                chat_groups.append(codes.setdefault(group, len(codes)))
+            for hit_type, hit, context, patron_or_operator, proper_noun_type in chat_log.hits:
+                self.hit_terms.append(term_codes.setdefault((hit_type, hit), len(term_codes)))
+                self.hit_speakers.append(speaker_codes.setdefault(patron_or_operator, len(speaker_codes)))
+            self.hit_chats.extend([chat] * len(chat_log.hits))
+
+    def close(self):
+        """
+        Count the summary tables and write them.
+        """
+        with measure("summary", rows=self.chat_count):
+            terms = [None] * len(self.term_codes)
+            for term, code in self.term_codes.items():
+                terms[code] = term
+            #The number of distinct chats of each term is the number of distinct (chat, term) pairs of the term
+            hit_counts = collections.Counter(self.hit_terms) if numpy is None else numpy.bincount(numpy.asarray(self.hit_terms, dtype=numpy.int64), minlength=len(terms)).tolist()
+            chat_counts = collections.Counter(term for chat, term, count in count_pairs(self.hit_chats, self.hit_terms, len(terms)))
+            rows = [[terms[code][0], terms[code][1], hit_counts[code], chat_counts[code]] for code in range(len(terms))]
+            rows.sort(key=lambda row: (-row[2], row[0], row[1]))
+            self.write_table("terms", ["Hit Type", "Hit", "Hits", "Chats" if MODE == "ask_chat" else "Tickets"], rows)
+            if numpy is not None:
+                hit_chats = numpy.asarray(self.hit_chats, dtype=numpy.int64)
+            for (table, columns), codes, chat_groups in zip(self.tables, self.group_codes, self.chat_groups):
+                #Look up the group of each hit from the group of its chat
+                if numpy is None:
+                    hit_groups = [chat_groups[chat] for chat in self.hit_chats]
                 else:
-                    for i in range(len(chat_log[len(chat_log) - 5])): #Iterate over each hit
-                        row = chat_log[:len(chat_log) - 5]
-                        row.pop(11) #Remove text
-                        row.pop(9) #Remove ip
-                        row.pop(8) #Remove operator
-                        if i > 0: #Remove id if not a unique log, so we can differentiate between unique logs easily
-                            row[0] = ""
-                        #Add operator data
-                        row.append(get_referrer_domain(chat_log[10]))
-                        row.append(get_operator_institution(chat_log[8]))
-                        operator_data = get_operator_data(chat_log[8], names)
-                        row.append(operator_data[0])
-                        row.append(operator_data[1])
-                        row.append("")
-                        row.append("")
-                        #Add all hit data
-                        row.append(chat_log[len(chat_log) - 5][i])
-                        row.append(chat_log[len(chat_log) - 4][i])
-                        row.append(chat_log[len(chat_log) - 3][i])
-                        row.append(chat_log[len(chat_log) - 2][i])
-                        row.append(chat_log[len(chat_log) - 1][i])
-
-                        writer.writerow(row)
-        if MODE == "jira":
-            writer.writerow(["Summary", "Issue key", "Issue id", "Issue Type", "Status", "Project key", "Project name", "Project type", "Project url", "Priority", "Resolution", "Created", "Updated", "Last Viewed", "Resolved", "Redacted?", "Notes", "Hit Type", "Hit", "Hit Context", "Proper noun classification"])
-            for chat_log in data:
-                for i in range(len(chat_log[len(chat_log) - 1])): #Iterate over each hit
-                    row = []
-                    row.append(chat_log[headers.index("Summary")])
-                    row.append(chat_log[headers.index("Issue key")])
-                    if i > 0:
-                        row.append("")
-                    else:
-                        row.append(chat_log[headers.index("Issue id")])
-                    row.append(chat_log[headers.index("Issue Type")])
-                    row.append(chat_log[headers.index("Status")])
-                    row.append(chat_log[headers.index("Project key")])
-                    row.append(chat_log[headers.index("Project name")])
-                    row.append(chat_log[headers.index("Project type")])
-                    row.append(chat_log[headers.index("Project url")])
-                    row.append(chat_log[headers.index("Priority")])
-                    row.append(chat_log[headers.index("Resolution")])
-                    row.append(chat_log[headers.index("Created")])
-                    row.append(chat_log[headers.index("Updated")])
-                    row.append(chat_log[headers.index("Last Viewed")])
-                    row.append(chat_log[headers.index("Resolved")])
-                    row.append("")
-                    row.append("")
-                    row.append(chat_log[len(chat_log) - 5][i])
-                    row.append(chat_log[len(chat_log) - 4][i])
-                    row.append(chat_log[len(chat_log) - 3][i])
-                    row.append(chat_log[len(chat_log) - 1][i])
-                    writer.writerow(row)
+                    hit_groups = numpy.asarray(chat_groups, dtype=numpy.int64)[hit_chats]
+                self.write_group_table(table, columns, codes, count_pairs(hit_groups, self.hit_terms, len(terms)), terms)
+            if MODE == "ask_chat":
+                codes = {(speaker,): code for speaker, code in self.speaker_codes.items()}
+                self.write_group_table("speaker", ("Sent by",), codes, count_pairs(self.hit_speakers, self.hit_terms, len(terms)), terms)
+
+    def write_group_table(self, table, columns, codes, counts, terms):
+        """
+        Write a summary table of the number of hits of each term in each group, sorted by group and then by most hits.
+        Parameters:
+            table: The name of the table
+            columns: The column headers of the group
+            codes: A dict of each group to its code
+            counts: A list of (group code, term code, count) tuples from count_pairs()
+            terms: A list of the (hit type, hit) of each term code
+        """
+        groups = [None] * len(codes)
+        for group, code in codes.items():
+            groups[code] = group
+        counts.sort(key=lambda count: (groups[count[0]], -count[2], terms[count[1]]))
+        self.write_table(table, list(columns) + ["Hit Type", "Hit", "Hits"], [list(groups[group]) + [terms[term][0], terms[term][1], count] for group, term, count in counts])
+
+    def write_table(self, table, headers, rows):
+        with open(self.filename.format(table), 'w', buffering=EXPORT_BUFFER_SIZE) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(headers)
+            writer.writerows(rows)
+
+def analyze_batch(data, headers, matcher):
+    """
+    Split, query and find proper nouns in a batch of rows from one file.
+    Parameters:
+        data: A list of rows from a csv file, or a CSVShard of the file to parse first
+        headers: A list containing the name of each column header of the file
+        matcher: A TermMatcher built from the terms to query for.
+    Returns:
+        A list with the analyzed rows in the 0th index, the CPU time spent querying in the 1st index and the CPU time spent analyzing proper nouns in the 2nd index.
+    """
+    get_data_array_text_location(headers)
+    if isinstance(data, CSVShard):
+        #Shards are parsed where they are analyzed, so that parsing is spread across worker processes
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        data = data.read_rows()
+        if metrics:
+            metrics.add_stage("read_csv", time.perf_counter() - wall, time.process_time() - cpu, rows=len(data))
+    #Split sentences
+    with measure("split_sentences", rows=len(data)):
+        data = split_sentences(data)
+    if metrics:
+        lines = sum(chat_log.line_count() for chat_log in data)
+        characters = sum(len(chat_log.text) for chat_log in data)
+    else:
+        lines = characters = 0
+    #Search for query terms
+    start = time.process_time()
+    with measure("iterate_query", len(data), lines, characters):
+        data = iterate_query(data, matcher)
+    query_time = time.process_time() - start
+    #Search for proper nouns
+    start = time.process_time()
+    if ner_enabled:
+        with measure("analyze_proper_nouns", len(data), lines, characters):
+            data = analyze_proper_nouns(data)
+    proper_noun_time = time.process_time() - start
+    return [data, query_time, proper_noun_time]
+
+#The TermMatcher used by a worker process, set by initialize_worker()
+worker_matcher = None
+
+def initialize_worker(mode, matcher, ner_cache=None, ner_cache_size=None, collect_metrics=False, find_proper_nouns=True, proper_noun_batch_size=1000, query_cache_size=0):
+    """
+    Set up the global state of a worker process in the pool.
+    Parameters:
+        mode: The mode of the analysis, either ask_chat or jira
+        matcher: A TermMatcher built from the terms to query for.
+        ner_cache: The file of the EntityCache to use, or None
+        ner_cache_size: The greatest number of entries in the EntityCache
+        collect_metrics: Whether to collect Metrics for each batch
+        find_proper_nouns: Whether to find proper nouns with spaCy
+        proper_noun_batch_size: The number of logs spaCy analyzes at a time
+        query_cache_size: The greatest number of lines in the QueryCache, or 0 to query every line
+    """
+    global MODE, worker_matcher, entity_cache, metrics, ner_enabled, ner_batch_size, query_cache
+    MODE = mode
+    worker_matcher = matcher
+    ner_enabled = find_proper_nouns
+    ner_batch_size = proper_noun_batch_size
+    metrics = Metrics() if collect_metrics else None
+    query_cache = QueryCache(query_cache_size) if query_cache_size else None
+    #Each worker opens its own connection, since SQLite connections can not be shared between processes
+    entity_cache = EntityCache(ner_cache, ner_cache_size) if ner_cache else None
+
+def initialize_pool_worker(*args):
+    """
+    Set up a worker process in the pool. Workers ignore Ctrl+C, so that only the main process handles it and stops the pool. A worker interrupted while waiting for a batch can leave the pool unable to stop. See initialize_worker() for the arguments.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    initialize_worker(*args)
+
+def analyze_batch_in_worker(data, headers):
+    """
+    Analyze a batch of rows in a worker process. See analyze_batch().
+    Returns:
+        The result of analyze_batch(), with the Metrics collected for the batch, or None, in the 3rd index, and the QueryCache counts of the batch, or None, in the 4th index.
+    """
+    global metrics
+    if metrics:
+        metrics = Metrics()
+    query_cache_stats = query_cache.stats.copy() if query_cache else None
+    result = analyze_batch(data, headers, worker_matcher) + [metrics]
+    if query_cache:
+        query_cache_stats = query_cache.stats - query_cache_stats
+    return result + [query_cache_stats]
+
+def create_pool(workers, matcher, ner_cache=None, ner_cache_size=None, always=False):
+    """
+    Create a pool of worker processes to analyze batches of rows in parallel. Workers collect metrics if metrics are being collected in this process, and use the same proper noun settings and query cache size as this process. Each worker has its own QueryCache.
+    Parameters:
+        workers: The number of worker processes
+        matcher: A TermMatcher built from the terms to query for.
+        ner_cache: The file of the EntityCache for workers to use, or None
+        ner_cache_size: The greatest number of entries in the EntityCache
+        always: Whether to create a pool even if workers is 1
+    Returns:
+        A multiprocessing pool, or None if workers is 1 or less and always is not set.
+    """
+    if workers <= 1 and not always:
+        return None
+    return multiprocessing.Pool(workers, initializer=initialize_pool_worker, initargs=(MODE, matcher, ner_cache, ner_cache_size, metrics is not None, ner_enabled, ner_batch_size, query_cache.max_entries if query_cache else 0))
+
+def analyze_batches(batches, headers, matcher, pool=None, workers=1):
+    """
+    Analyze each batch of rows, in a pool of worker processes if one is given. Results are produced in the order of batches, whichever worker finishes first.
+    At most two batches per worker are in progress at a time, so that batches are not read faster than they can be analyzed.
+    Parameters:
+        batches: An iterable of lists of rows from one file
+        headers: A list containing the name of each column header of the file
+        matcher: A TermMatcher built from the terms to query for.
+        pool: A pool from create_pool(), or None to analyze batches in this process
+        workers: The number of worker processes in pool
+    Yields:
+        The result of analyze_batch() for each batch, in order
+    """
+    if pool is None:
+        for data in batches:
+            yield analyze_batch(data, headers, matcher)
+        return
+    pending = collections.deque()
+    for data in batches:
+        pending.append(pool.apply_async(analyze_batch_in_worker, (data, headers)))
+        if len(pending) >= 2 * workers:
+            yield collect_worker_result(pending.popleft().get())
+    while pending:
+        yield collect_worker_result(pending.popleft().get())
+
+def collect_worker_result(result):
+    """
+    Merge the Metrics and QueryCache counts returned by analyze_batch_in_worker() into metrics and query_cache, and return the rest of the result.
+    """
+    if metrics and result[3]:
+        metrics.merge(result[3])
+    if query_cache and result[4]:
+        query_cache.stats.update(result[4])
+    return result[:3]
 
 #Take the file from filename, run querying and processing, and add its data to return_data.
-def add_file_data(filename, terms, return_data, export_filename=None):
+def add_file_data(filename, matcher, return_data, export_filename=None, pool=None, workers=1, export_format=None, shard_size=None):
     """
-    For a given file, analyze it for hits and add its data to return data. If export_filename has a value, then export the data as a .csv file.
+    For a given file, analyze it for hits and add its data to return data. If export_filename has a value, then export the data.
     Parameters:
         filename: The name of the file to read data from.
-        terms: A list containing each term to query for.
+        matcher: A TermMatcher built from the terms to query for.
         return_data: A list of previously analyzed data to add this data to.
         export_filename: If this variable has a value, then export the data as this filename.
+        pool: A pool from create_pool() to analyze the file in parallel, or None.
+        workers: The number of worker processes in pool.
+        export_format: csv, parquet or sqlite, or None to choose by the extension of export_filename.
+        shard_size: If this variable has a value, split the file into shards of about this many bytes, which are parsed along with their analysis. See get_csv_shards().
     Return:
         return_data: A list containing all data that has been analyzed, including data from filename.
     """
     #Get headers and data
     print("Analyzing file", filename)
-    data = convertcsv(filename)
-    headers = data[1]
-    data = data[0]
-    #Split sentences
-    get_data_array_text_location(headers)
-    data = split_sentences(data)
-
-    start = time.process_time()
-    #Search for query terms
-    data = iterate_query(data, terms)
-    print("Querying took", time.process_time() - start, "seconds")
-    #Search for proper nouns
-    start = time.process_time()
-    data = analyze_proper_nouns(data)
-    print("Analyzing proper nouns took", time.process_time() - start, "seconds")
-    #Add data to return_data
-    for row in data:
-        return_data.append(row)
+    if shard_size:
+        with measure("find_shards"):
+            headers, batches = get_csv_shards(filename, shard_size)
+        get_data_array_text_location(headers)
+    else:
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        data = convertcsv(filename)
+        if metrics:
+            metrics.add_stage("read_csv", time.perf_counter() - wall, time.process_time() - cpu, rows=len(data[0]))
+        headers = data[1]
+        data = data[0]
+        get_data_array_text_location(headers)
+        #Split the rows evenly between workers, with a few batches each to balance the load
+        batch_size = max(1, math.ceil(len(data) / (workers * 4))) if pool else max(1, len(data))
+        batches = [data[i:i + batch_size] for i in range(0, len(data), batch_size)]
+    query_time = 0
+    proper_noun_time = 0
+    for batch, batch_query_time, batch_proper_noun_time in analyze_batches(batches, headers, matcher, pool, workers):
+        #Add data to return_data
+        for row in batch:
+            return_data.append(row)
+        query_time += batch_query_time
+        proper_noun_time += batch_proper_noun_time
+    print("Querying took", query_time, "seconds")
+    print("Analyzing proper nouns took", proper_noun_time, "seconds")
     #Export if export_filename has a value
     if export_filename:
-        export_csv(return_data, headers, export_filename)
+        export_csv(return_data, headers, export_filename, export_format)
     return return_data
 
+def read_csv_batches(filename, batch_size):
+    """
+    Read the rows of a csv file in batches, without loading the whole file into memory.
+    Parameters:
+        filename: The directory of the file. Must be in a .csv format
+        batch_size: The greatest number of rows in each batch
+    Yields:
+        A list object storing each column header, followed by one list of at most batch_size rows at a time
+    """
+    with open(filename) as csvfile:
+        reader = csv.reader(csvfile)
+        yield next(reader)
+        batch = []
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for row in reader:
+            batch.append(row)
+            if len(batch) == batch_size:
+                if metrics:
+                    metrics.add_stage("read_csv", time.perf_counter() - wall, time.process_time() - cpu, rows=len(batch))
+                yield batch
+                batch = []
+                wall = time.perf_counter()
+                cpu = time.process_time()
+        if batch:
+            if metrics:
+                metrics.add_stage("read_csv", time.perf_counter() - wall, time.process_time() - cpu, rows=len(batch))
+            yield batch
+
+class CSVShard:
+    """
+    A byte range of a csv file that starts and ends on a record boundary, so that it can be parsed on its own, in a worker process. See get_csv_shards().
+    Parameters:
+        filename: The directory of the file
+        start: The offset of the first byte of the shard
+        end: The offset one past the last byte of the shard
+    """
+    def __init__(self, filename, start, end):
+        self.filename = filename
+        self.start = start
+        self.end = end
+
+    def read_rows(self):
+        """
+        Parse the rows in the shard, the same way convertcsv() parses a whole file.
+        """
+        with open(self.filename, "rb") as csvfile:
+            csvfile.seek(self.start)
+            chunk = csvfile.read(self.end - self.start)
+        return list(csv.reader(io.TextIOWrapper(io.BytesIO(chunk))))
+
+#The number of bytes of a memory mapped file that count_quotes() copies at a time
+QUOTE_COUNT_CHUNK_SIZE = 1024 * 1024
+
+def count_quotes(csvmap, start, end):
+    """
+    Return the number of quote characters between offsets start and end of a memory mapped file, copying at most QUOTE_COUNT_CHUNK_SIZE bytes at a time.
+    """
+    quotes = 0
+    for chunk_start in range(start, end, QUOTE_COUNT_CHUNK_SIZE):
+        quotes += csvmap[chunk_start:min(end, chunk_start + QUOTE_COUNT_CHUNK_SIZE)].count(b'"')
+    return quotes
+
+def get_csv_shards(filename, shard_size):
+    """
+    Split a csv file into shards of about shard_size bytes, which worker processes can parse in parallel.
+    The file is memory mapped and scanned for record boundaries. A newline ends a record unless it is inside a quoted field, which is the case when an odd number of quotes come before it in the file, since quotes inside a quoted field are doubled. Fields must be quoted this way whenever they contain a newline or a quote, as they are in JIRA and Ask Chat exports.
+    Only the quotes between shard boundaries are counted, with one scan of the bytes, and newlines are only looked at near each boundary.
+    Parameters:
+        filename: The directory of the file. Must be in a .csv format
+        shard_size: The size in bytes each shard is at least, other than the last
+    Returns:
+        A list object storing each column header, and a list of CSVShard objects covering the rest of the file, in order
+    """
+    with open(filename, "rb") as csvfile:
+        size = os.fstat(csvfile.fileno()).st_size
+        if size == 0:
+            raise ValueError(filename + " is empty")
+        with mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ) as csvmap:
+            boundaries = [0]
+            quotes = 0 #The number of quotes before position
+            position = 0
+            target = 0 #The first boundary is the end of the headers
+            while True:
+                #Skip to where the next shard could end
+                if target > position:
+                    target = min(target, size)
+                    quotes += count_quotes(csvmap, position, target)
+                    position = target
+                newline = csvmap.find(b"\n", position)
+                if newline == -1:
+                    break
+                quotes += count_quotes(csvmap, position, newline)
+                position = newline + 1
+                if quotes % 2 == 0:
+                    boundaries.append(position)
+                    target = position + shard_size
+            if boundaries[-1] < size:
+                boundaries.append(size)
+    headers = next(iter(CSVShard(filename, boundaries[0], boundaries[1]).read_rows()))
+    return [headers, [CSVShard(filename, boundaries[i], boundaries[i + 1]) for i in range(1, len(boundaries) - 1)]]
+
+def stream_file_data(filename, matcher, export, batch_size, pool=None, workers=1, state=None, shard_size=None):
+    """
+    For a given file, analyze it for hits one batch of rows at a time, and write each batch to the export as soon as it is analyzed.
+    Parameters:
+        filename: The name of the file to read data from.
+        matcher: A TermMatcher built from the terms to query for.
+        export: The export to write hits to, from open_export().
+        batch_size: The greatest number of rows in each batch.
+        pool: A pool from create_pool() to analyze batches in parallel, or None.
+        workers: The number of worker processes in pool.
+        state: A StateStore to skip rows that have not changed since an earlier run, or None to analyze every row.
+        shard_size: If this variable has a value, read the file in shards of about this many bytes instead of batches of batch_size rows. Shards are parsed along with their analysis. See get_csv_shards().
+    """
+    print("Analyzing file", filename)
+    if shard_size:
+        with measure("find_shards"):
+            headers, batches = get_csv_shards(filename, shard_size)
+    else:
+        batches = read_csv_batches(filename, batch_size)
+        headers = next(batches)
+    get_data_array_text_location(headers)
+    if state:
+        batches = state.filter_changed(batches, get_record_id_location(headers))
+    query_time = 0
+    proper_noun_time = 0
+    for data, batch_query_time, batch_proper_noun_time in analyze_batches(batches, headers, matcher, pool, workers):
+        query_time += batch_query_time
+        proper_noun_time += batch_proper_noun_time
+        with measure("export", rows=len(data)):
+            export.write(data, headers)
+    print("Querying took", query_time, "seconds")
+    print("Analyzing proper nouns took", proper_noun_time, "seconds")
+
+def stream_files(filenames, matcher, export_filename, batch_size, pool=None, workers=1, state=None, export_format=None, shard_size=None):
+    """
+    Analyze each file in filenames and export the hits, keeping a bounded number of rows in memory at a time.
+    Parameters:
+        filenames: A list of the names of the files to read data from.
+        matcher: A TermMatcher built from the terms to query for.
+        export_filename: The filename to export as.
+        batch_size: The greatest number of rows in each batch.
+        pool: A pool from create_pool() to analyze batches in parallel, or None.
+        workers: The number of worker processes in pool.
+        state: A StateStore to skip rows that have not changed since an earlier run, or None to analyze every row.
+        export_format: csv, parquet or sqlite, or None to choose by the extension of export_filename.
+        shard_size: If this variable has a value, read each file in shards of about this many bytes. See stream_file_data().
+    """
+    export = open_export(export_filename, export_format)
+    try:
+        for filename in filenames:
+            stream_file_data(filename, matcher, export, batch_size, pool, workers, state, shard_size)
+    finally:
+        export.close()
+
+def get_record_id_location(headers):
+    """
+    Return the index of the column that identifies each chat or ticket in an input file.
+    Parameters:
+        headers: A List containg the name of each column header.
+    """
+    if MODE == "jira":
+        return headers.index("Issue id")
+    return 0
+
+def get_analysis_version(terms):
+    """
+    Return a hash of everything besides the input that decides which hits are found: the mode, the list of terms and whether proper nouns are found.
+    Parameters:
+        terms: A list of strings, each containing a term to search for
+    """
+    settings = [MODE, "ner" if ner_enabled else "no ner"] + terms
+    return hashlib.sha256("\n".join(settings).encode("utf-8")).hexdigest()
+
+class StateStore:
+    """
+    A local SQLite store of the chats or tickets exported by earlier runs, so that incremental runs only analyze records that are new or have changed.
+    Each record is stored by its id, with a hash of its row and the analysis version from get_analysis_version(). A record counts as unchanged only if both are the same.
+    Parameters:
+        path: The file to store the state in
+        version: The analysis version of this run
+    """
+    def __init__(self, path, version):
+        self.version = version
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS records (mode TEXT NOT NULL, record_id TEXT NOT NULL, record_hash TEXT NOT NULL, version TEXT NOT NULL, PRIMARY KEY (mode, record_id))")
+        self.updates = {} #Record id -> hash of each record analyzed in this run
+        self.analyzed = {} #Record id -> number of times the record was analyzed in this run
+        self.skipped = 0
+
+    def get_hashes(self, record_ids):
+        """
+        Return a dict mapping each record id that was exported with the current analysis version to the hash of its row.
+        """
+        hashes = {}
+        for i in range(0, len(record_ids), CACHE_QUERY_SIZE):
+            chunk = record_ids[i:i + CACHE_QUERY_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            hashes.update(self.connection.execute("SELECT record_id, record_hash FROM records WHERE mode = ? AND version = ? AND record_id IN (" + placeholders + ")", [MODE, self.version] + chunk))
+        return hashes
+
+    def filter_changed(self, batches, id_location):
+        """
+        Remove rows that are unchanged since they were last exported, or since they were seen earlier in this run.
+        Parameters:
+            batches: An iterable of lists of rows from one file
+            id_location: The index of the column that identifies each row, from get_record_id_location()
+        Yields:
+            Each batch with only its new or changed rows, skipping batches with none
+        """
+        for batch in batches:
+            stored = self.get_hashes(list(set(row[id_location] for row in batch)))
+            changed = []
+            for row in batch:
+                record_id = row[id_location]
+                record_hash = hashlib.sha256("\x1f".join(row).encode("utf-8")).hexdigest()
+                if self.updates.get(record_id, stored.get(record_id)) == record_hash:
+                    self.skipped += 1
+                else:
+                    self.updates[record_id] = record_hash
+                    self.analyzed[record_id] = self.analyzed.get(record_id, 0) + 1
+                    changed.append(row)
+            if changed:
+                yield changed
+
+    def forget(self):
+        """
+        Forget every record exported in mode, for example because the export they were merged into is gone.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM records WHERE mode = ?", (MODE,))
+
+    def save(self):
+        """
+        Store the records analyzed in this run. Call once their hits are in the export.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", [(MODE, record_id, record_hash, self.version) for record_id, record_hash in self.updates.items()])
+
+    def close(self):
+        self.connection.close()
+
+def read_export_records(filename):
+    """
+    Read the rows of an export, grouped by the chat or ticket they belong to.
+    Parameters:
+        filename: The name of an export written by this script
+    Yields:
+        A tuple of the record id and a list of its rows, for each chat or ticket in the export
+    """
+    id_column = EXPORT_ID_COLUMN[MODE]
+    with open(filename, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        record_id = None
+        rows = []
+        for row in reader:
+            #Only the first row of each record has its id
+            if row[id_column] != "":
+                if rows:
+                    yield record_id, rows
+                record_id = row[id_column]
+                rows = []
+            rows.append(row)
+        if rows:
+            yield record_id, rows
+
+class IncrementalHitsExport(CSVExport):
+    """
+    The .csv file of the hits found in an incremental run, before they are merged into the export.
+    Each row starts with the id of its chat or ticket and the number of the version of that record it was found in, counting each time the record is analyzed in this run from 1. This tells apart the hits of a record that appears more than once, even when an earlier version has hits and a later one has none.
+    Parameters:
+        filename: The filename to write the hits to
+    """
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.versions = {} #Record id -> number of times the record was written
+
+    def write(self, data, headers):
+        """
+        Write the hits of a list of analyzed ChatLog objects, each row preceded by its record id and version.
+        Parameters:
+            data: A list of analyzed ChatLog objects to export
+            headers: A list of all column headers of the file data was read from
+        """
+        id_location = get_record_id_location(headers)
+        id_column = EXPORT_ID_COLUMN[MODE]
+        for chat_log in data:
+            record_id = chat_log.row[id_location]
+            version = self.versions.get(record_id, 0) + 1
+            self.versions[record_id] = version
+            rows = get_export_rows(chat_log, headers, self.names)
+            #Remove id if not a unique log, the same as in the export
+            for row in rows[1:]:
+                row[id_column] = ""
+            self.writer.writerows([record_id, version] + row for row in rows)
+
+def incremental_files(filenames, matcher, export_filename, state_path, batch_size, pool=None, workers=1):
+    """
+    Analyze only the chats or tickets in filenames that are new or have changed since an earlier run, and merge their hits into the existing .csv export.
+    Rows of unchanged records are kept in the export in their original order. Rows of new or changed records replace any earlier rows for the same record, and are added at the end.
+    Parameters:
+        filenames: A list of the names of the files to read data from.
+        matcher: A TermMatcher built from the terms to query for.
+        export_filename: The filename of the export to merge into. It is created if it does not exist.
+        state_path: The file of the StateStore.
+        batch_size: The greatest number of rows in each batch.
+        pool: A pool from create_pool() to analyze batches in parallel, or None.
+        workers: The number of worker processes in pool.
+    """
+    state = StateStore(state_path, get_analysis_version(matcher.terms))
+    if not os.path.exists(export_filename):
+        #There is no export to merge into, so every record must be analyzed again
+        state.forget()
+    hits_filename = export_filename + ".hits.tmp"
+    merged_filename = export_filename + ".tmp"
+    try:
+        export = IncrementalHitsExport(hits_filename)
+        try:
+            for filename in filenames:
+                stream_file_data(filename, matcher, export, batch_size, pool, workers, state)
+        finally:
+            export.close()
+        with open(merged_filename, 'w', buffering=EXPORT_BUFFER_SIZE) as csvfile:
+            writer = csv.writer(csvfile)
+            write_export_headers(writer)
+            if os.path.exists(export_filename):
+                for record_id, rows in read_export_records(export_filename):
+                    if record_id not in state.analyzed:
+                        writer.writerows(rows)
+            #If a record was analyzed more than once in this run, only keep the hits of its last version
+            with open(hits_filename, newline='') as hitsfile:
+                reader = csv.reader(hitsfile)
+                next(reader, None)
+                for row in reader:
+                    if int(row[1]) == state.analyzed[row[0]]:
+                        writer.writerow(row[2:])
+        os.replace(merged_filename, export_filename)
+        state.save()
+        print("Incremental run:", len(state.analyzed), "new or changed records analyzed,", state.skipped, "unchanged records skipped")
+    finally:
+        state.close()
+        for filename in (hits_filename, merged_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+#The number of rows analyzed at a time by a service job that reads files, unless the job sets batch_size
+SERVICE_BATCH_SIZE = 1000
+
+def run_job(job):
+    """
+    Run an analysis job of the service. Called in a worker process of the service's pool, or in the main thread of the service process if it reads jobs from stdin with one worker.
+    A job is a dict with these keys:
+        id: Any value, returned with the response so that it can be matched with its job
+        mode: ask_chat or jira
+        files: A list of .csv files to analyze. Alternatively, headers and rows hold the contents of a .csv file inline
+        export: The filename to export as, in any format supported by open_export(). If it is not given, the hits are returned in the response
+        export_format, summary: The same as the --export-format and --summary options. Only used with export
+        batch_size: The number of rows analyzed at a time when reading files (default: SERVICE_BATCH_SIZE)
+    Returns:
+        A dict with the id of the job and its status, ok or error. An ok response has the number of seconds the job took, and, if the job has no export, the headers and rows of its hits, with the id of the chat or ticket on every row. An error response has an error message.
+    """
+    global MODE, query_cache, export_hits, export_summary
+    start = time.perf_counter()
+    try:
+        if job.get("mode") not in ("ask_chat", "jira"):
+            raise ValueError("mode must be ask_chat or jira")
+        if job["mode"] != MODE and query_cache:
+            #The user data removed from each line depends on the mode, so cached hits can not be shared between modes
+            query_cache = QueryCache(query_cache.max_entries)
+        MODE = job["mode"]
+        export_hits = True
+        export_summary = bool(job.get("summary"))
+        response = {"id": job.get("id"), "status": "ok"}
+        #Progress messages go to stderr, since stdout may be carrying responses
+        with contextlib.redirect_stdout(sys.stderr):
+            if "files" in job and job.get("export"):
+                stream_files(job["files"], worker_matcher, job["export"], job.get("batch_size", SERVICE_BATCH_SIZE), export_format=job.get("export_format"))
+            else:
+                if "files" in job:
+                    inputs = []
+                    for filename in job["files"]:
+                        rows, headers = convertcsv(filename)
+                        inputs.append((headers, rows))
+                elif "headers" in job and "rows" in job:
+                    inputs = [(job["headers"], [list(row) for row in job["rows"]])]
+                else:
+                    raise ValueError("a job must have files, or headers and rows")
+                if job.get("export"):
+                    export = open_export(job["export"], job.get("export_format"))
+                    try:
+                        for headers, rows in inputs:
+                            export.write(analyze_batch(rows, headers, worker_matcher)[0], headers)
+                    finally:
+                        export.close()
+                else:
+                    names = load_operator_directory("names.csv") if MODE == "ask_chat" else None
+                    response["headers"] = get_export_headers()
+                    response["rows"] = []
+                    for headers, rows in inputs:
+                        for chat_log in analyze_batch(rows, headers, worker_matcher)[0]:
+                            response["rows"].extend(get_export_rows(chat_log, headers, names))
+    except Exception as error:
+        return {"id": job.get("id"), "status": "error", "error": type(error).__name__ + ": " + str(error)}
+    response["seconds"] = time.perf_counter() - start
+    return response
+
+def write_response(stream, lock, response):
+    """
+    Write the response to a job to a stream as a JSON line. The lock keeps responses to jobs that finish at the same time from being interleaved.
+    """
+    with lock:
+        stream.write(json.dumps(response) + "\n")
+        stream.flush()
+
+def finish_job(job_id, respond, slots, response):
+    """
+    Respond to a job run in the pool, and free its slot. If the job failed outside of run_job(), response is the exception.
+    This is called by the pool's result thread, so errors are not raised, since they would stop the pool from handling any more results.
+    """
+    try:
+        if isinstance(response, BaseException):
+            response = {"id": job_id, "status": "error", "error": type(response).__name__ + ": " + str(response)}
+        respond(response)
+    except (OSError, ValueError):
+        pass #The client disconnected, so the response can not be sent
+    finally:
+        slots.release()
+
+def serve_jobs(lines, respond, pool, max_pending):
+    """
+    Run each job read from a stream of JSON lines, responding to each job as it finishes. Jobs run at the same time in the pool, so responses may not be in the order of their jobs.
+    Returns once every job has been responded to.
+    Parameters:
+        lines: An iterable of strings, each containing a job as a JSON object. See run_job()
+        respond: A function called with the response to each job
+        pool: A pool from create_pool() to run jobs in, or None to run them one at a time in this thread. Only one thread may run jobs without a pool
+        max_pending: The greatest number of jobs from lines that are queued or running at a time. Reading lines waits for a slot.
+    """
+    slots = threading.BoundedSemaphore(max_pending)
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("a job must be a JSON object")
+        except ValueError as error:
+            respond({"id": None, "status": "error", "error": "Invalid job: " + str(error)})
+            continue
+        if pool is None:
+            respond(run_job(job))
+            continue
+        slots.acquire()
+        callback = functools.partial(finish_job, job.get("id"), respond, slots)
+        pool.apply_async(run_job, (job,), callback=callback, error_callback=callback)
+    #Wait for the jobs still running, by taking every slot
+    for i in range(max_pending):
+        slots.acquire()
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a connection to the service's Unix socket. The client sends jobs as JSON lines and receives a JSON line in response to each. See serve_jobs().
+    """
+    def handle(self):
+        lines = io.TextIOWrapper(self.rfile, encoding="utf-8")
+        stream = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+        respond = functools.partial(write_response, stream, threading.Lock())
+        try:
+            serve_jobs(lines, respond, self.server.pool, self.server.max_pending)
+        except (BrokenPipeError, ConnectionResetError):
+            pass #The client disconnected
+
+def serve(args):
+    """
+    Run the analysis service. The term matcher and the spaCy pipeline are loaded once, before any worker process is created, so that each job can start analyzing right away.
+    Jobs are read from stdin, with responses written to stdout, or from connections to a Unix socket if args.socket is set.
+    Parameters:
+        args: An argparse namespace from parse_service_arguments()
+    """
+    global MODE, ner_enabled, ner_batch_size, query_cache
+    MODE = "ask_chat"
+    ner_enabled = not args.no_ner
+    ner_batch_size = args.ner_batch_size
+    query_cache = QueryCache(args.query_cache_size) if args.query_cache_size else None
+    terms = initialize_query_return_data(convertcsv('text_terms_DS.txt')[0])
+    matcher = TermMatcher(terms)
+    if ner_enabled:
+        get_nlp()
+    #Connections to the socket are handled in threads, which can not share the global settings of a job or the connection of the EntityCache, so their jobs always run in the pool
+    pool = create_pool(args.workers, matcher, args.ner_cache, args.ner_cache_size, always=bool(args.socket))
+    if pool is None:
+        #Jobs run in this process, so set it up the way a worker would be
+        initialize_worker(MODE, matcher, args.ner_cache, args.ner_cache_size, False, ner_enabled, ner_batch_size, args.query_cache_size)
+    try:
+        if args.socket:
+            if os.path.exists(args.socket):
+                os.remove(args.socket)
+            with socketserver.ThreadingUnixStreamServer(args.socket, JobRequestHandler) as server:
+                server.daemon_threads = True
+                server.pool = pool
+                server.max_pending = args.max_pending
+                print("Listening on", args.socket, file=sys.stderr)
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+        else:
+            print("Reading jobs from stdin", file=sys.stderr)
+            serve_jobs(sys.stdin, functools.partial(write_response, sys.stdout, threading.Lock()), pool, args.max_pending)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+def parse_service_arguments(argv):
+    """
+    Parse the command line arguments of the service.
+    Parameters:
+        argv: A list of command line arguments, not including the name of the script and serve
+    Returns:
+        An argparse namespace
+    """
+    parser = argparse.ArgumentParser(prog="script.py serve", description="Keep the term matcher and spaCy loaded, and run analysis jobs sent as JSON lines on stdin or to a Unix socket.")
+    parser.add_argument("--socket", metavar="PATH", help="Listen for jobs on a Unix socket at PATH, instead of reading them from stdin")
+    parser.add_argument("--workers", type=int, default=2, help="The number of worker processes that run jobs at the same time (default: 2)")
+    parser.add_argument("--max-pending", type=int, default=16, help="The greatest number of jobs from one connection that are queued or running at a time (default: 16)")
+    parser.add_argument("--ner-cache", metavar="FILE", help="An SQLite file caching the proper nouns found in each chat. See script.py --help")
+    parser.add_argument("--ner-cache-size", type=int, default=1000000, help="The greatest number of chats kept in the proper noun cache (default: 1000000)")
+    parser.add_argument("--no-ner", action="store_true", help="Only search for query terms, file extensions and course codes, without finding proper nouns. spaCy is not loaded.")
+    parser.add_argument("--ner-batch-size", type=int, default=1000, help="The number of chats spaCy analyzes at a time (default: 1000)")
+    parser.add_argument("--query-cache-size", type=int, default=100000, help="The greatest number of distinct lines whose query hits are cached by each worker, or 0 to query every line (default: 100000)")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_pending < 1:
+        parser.error("--max-pending must be at least 1")
+    if args.ner_batch_size < 1:
+        parser.error("--ner-batch-size must be at least 1")
+    if args.ner_cache_size < 1:
+        parser.error("--ner-cache-size must be at least 1")
+    if args.query_cache_size < 0:
+        parser.error("--query-cache-size can not be negative")
+    return args
+
+def parse_arguments(argv):
+    """
+    Parse command line arguments.
+    Parameters:
+        argv: A list of command line arguments, not including the name of the script
+    Returns:
+        An argparse namespace. Its files attribute holds the files to analyze and its export_file attribute holds the name of the file to export as.
+    """
+    parser = argparse.ArgumentParser(description="Analyze Ask Chat transcripts or JIRA tickets for query terms, file extensions, course codes and proper nouns.")
+    parser.add_argument("mode", choices=["ask_chat", "jira"], help="The type of the input files")
+    parser.add_argument("files", nargs="+", metavar="file", help="One or more .csv files to analyze, followed by the name of the file to export as")
+    parser.add_argument("--stream", action="store_true", help="Read, analyze and export rows in batches so that memory use does not grow with the size of the input")
+    parser.add_argument("--batch-size", type=int, default=1000, help="The number of rows in each batch when streaming (default: 1000)")
+    parser.add_argument("--workers", type=int, default=1, help="The number of worker processes that query and find proper nouns in parallel (default: 1)")
+    parser.add_argument("--shard-size", type=int, metavar="MB", help="Split each input file into shards of about MB megabytes on record boundaries, which the worker processes parse and analyze in parallel. Results are exported in the original order")
+    parser.add_argument("--ner-cache", metavar="FILE", help="An SQLite file caching the proper nouns found in each chat, so that chats analyzed in an earlier run are not run through spaCy again")
+    parser.add_argument("--incremental", metavar="STATE_FILE", help="Only analyze chats or tickets that are new or have changed since an earlier run with the same STATE_FILE, and merge their hits into the existing export file. Implies --stream.")
+    parser.add_argument("--no-ner", action="store_true", help="Only search for query terms, file extensions and course codes, without finding proper nouns. spaCy is not loaded.")
+    parser.add_argument("--ner-batch-size", type=int, default=1000, help="The number of chats spaCy analyzes at a time (default: 1000)")
+    parser.add_argument("--query-cache-size", type=int, default=100000, help="The greatest number of distinct lines whose query hits are cached, so that repeated lines are only queried once, or 0 to query every line (default: 100000)")
+    parser.add_argument("--export-format", choices=["csv", "parquet", "sqlite"], help="The format of the export file. By default it is chosen by the extension of the export file: .parquet for Parquet, .db, .sqlite or .sqlite3 for SQLite, and .csv otherwise")
+    parser.add_argument("--summary", action="store_true", help="Also write summary tables of the hits of each term by queue, month, operator and speaker (JIRA: by project, month and issue type) next to the export file")
+    parser.add_argument("--summary-only", action="store_true", help="Only write the summary tables, without a row for each hit. Implies --summary.")
+    parser.add_argument("--metrics", metavar="FILE", help="Write the time spent in each stage and query rule, the hits of each term, spaCy throughput and peak memory to a JSON file")
+    parser.add_argument("--ner-cache-size", type=int, default=1000000, help="The greatest number of chats kept in the proper noun cache (default: 1000000)")
+    args = parser.parse_args(argv)
+    if len(args.files) < 2:
+        parser.error("Please enter the mode, at least one .csv file to analyze, and output file name.")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.ner_batch_size < 1:
+        parser.error("--ner-batch-size must be at least 1")
+    if args.ner_cache_size < 1:
+        parser.error("--ner-cache-size must be at least 1")
+    if args.query_cache_size < 0:
+        parser.error("--query-cache-size can not be negative")
+    if args.shard_size is not None and args.shard_size < 1:
+        parser.error("--shard-size must be at least 1")
+    if args.shard_size and args.incremental:
+        parser.error("--shard-size can not be used with --incremental, since unchanged rows are skipped before they are analyzed")
+    args.export_file = args.files.pop()
+    args.export_format = get_export_format(args.export_file, args.export_format)
+    if args.export_format == "parquet" and not args.summary_only and importlib.util.find_spec("pyarrow") is None:
+        parser.error("pyarrow is needed to export as Parquet. Install it with: pip install pyarrow")
+    if args.incremental and args.export_format != "csv":
+        parser.error("--incremental can only merge into a .csv export")
+    if args.incremental and (args.summary or args.summary_only):
+        parser.error("--summary can not be used with --incremental, since only new or changed records are analyzed")
+    return args
+
 def main():
+    global MODE, entity_cache, metrics, ner_enabled, ner_batch_size, export_hits, export_summary, query_cache
+    if sys.argv[1:2] == ["serve"]:
+        serve(parse_service_arguments(sys.argv[2:]))
+        return
+    args = parse_arguments(sys.argv[1:])
+    MODE = args.mode
+    export_hits = not args.summary_only
+    export_summary = args.summary or args.summary_only
+    query_cache = QueryCache(args.query_cache_size) if args.query_cache_size else None
+    ner_enabled = not args.no_ner
+    ner_batch_size = args.ner_batch_size
+    if args.metrics:
+        metrics = Metrics()
+    start = time.perf_counter()
     terms = convertcsv('text_terms_DS.txt')[0]
     terms = initialize_query_return_data(terms)
+    matcher = TermMatcher(terms)
 
-    data = []
-    if len(sys.argv) > 3:
-        if sys.argv[1] != "ask_chat" or sys.argv[1] != "jira":
-            global MODE
-            MODE = sys.argv[1]
+    if ner_enabled and args.workers > 1 and not args.ner_cache:
+        #Load the model before creating the pool, so that worker processes can share it instead of each loading their own
+        #With a cache, logs analyzed in an earlier run do not need the model, so it is only loaded by the processes that find logs that are not cached
+        get_nlp()
+    #Create the pool before opening the cache, so that worker processes do not inherit its connection
+    pool = create_pool(args.workers, matcher, args.ner_cache, args.ner_cache_size)
+    shard_size = args.shard_size * 1024 * 1024 if args.shard_size else None
+    if args.ner_cache:
+        entity_cache = EntityCache(args.ner_cache, args.ner_cache_size)
+        cache_stats = entity_cache.get_stats()
+    try:
+        if args.incremental:
+            incremental_files(args.files, matcher, args.export_file, args.incremental, args.batch_size, pool, args.workers)
+        elif args.stream:
+            stream_files(args.files, matcher, args.export_file, args.batch_size, pool, args.workers, export_format=args.export_format, shard_size=shard_size)
         else:
-            print("Please enter a recognized mode: ask_chat or jira.")
-            exit(2)
-        for i in range(2, len(sys.argv) -1):
-            if i == len(sys.argv) - 2:
-                data = add_file_data(sys.argv[i], terms, data, sys.argv[len(sys.argv) -1])
-            else:
-                data = add_file_data(sys.argv[i], terms, data)
-    else:
-        print("Please enter the mode, at least one .csv file to analyze, and output file name.")
-        exit(1)
+            data = []
+            for i in range(len(args.files)):
+                if i == len(args.files) - 1:
+                    data = add_file_data(args.files[i], matcher, data, args.export_file, pool, args.workers, args.export_format, shard_size)
+                else:
+                    data = add_file_data(args.files[i], matcher, data, pool=pool, workers=args.workers, shard_size=shard_size)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if entity_cache:
+        stats = entity_cache.get_stats()
+        print("Proper noun cache:", stats["hits"] - cache_stats["hits"], "hits,", stats["misses"] - cache_stats["misses"], "misses,", stats["evictions"] - cache_stats["evictions"], "evictions,", stats["entries"], "entries")
+        entity_cache.close()
+    if query_cache:
+        stats = query_cache.get_stats()
+        print("Query cache:", stats["hits"], "hits,", stats["misses"], "misses,", stats["evictions"], "evictions,", stats["uncached"], "lines not cached,", "hit rate", "n/a" if stats["hit_rate"] is None else "{:.1%}".format(stats["hit_rate"]))
+    if metrics:
+        output = metrics.to_dict()
+        if query_cache:
+            output["query_cache"] = stats
+        output["wall_seconds"] = time.perf_counter() - start
+        output["workers"] = args.workers
+        with open(args.metrics, 'w') as jsonfile:
+            json.dump(output, jsonfile, indent=2)
     print("done")
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+import csv, os, subprocess, sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JIRA_HEADERS = ["Summary", "Issue key", "Issue id", "Issue Type", "Status", "Project key", "Project name", "Project type", "Project url", "Priority", "Resolution", "Assignee", "Reporter", "Created", "Updated", "Last Viewed", "Resolved", "Description"]
+
+def write_jira_file(filename, tickets):
+    """
+    Write a JIRA .csv file with one row for each (issue id, description) in tickets.
+    """
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(JIRA_HEADERS)
+        for issue_id, description in tickets:
+            writer.writerow(["Summary", "DS-" + issue_id, issue_id, "Task", "Done", "DS", "Digital Scholarship", "software", "", "Medium", "Done", "", "", "2021-01-01 12:00", "2021-01-01 12:00", "", "", description])
+
+def run_script(*args):
+    subprocess.run([sys.executable, os.path.join(REPO, "script.py"), "--no-ner"] + list(args), cwd=REPO, check=True, stdout=subprocess.DEVNULL)
+
+def read_hits(filename):
+    with open(filename, newline='') as csvfile:
+        return sorted(row[-3] for row in list(csv.reader(csvfile))[1:])
+
+def test_duplicate_record_keeps_hits_of_last_version(tmp_path):
+    #The first version of the ticket has no hits, so it writes no rows
+    first = str(tmp_path / "a.csv")
+    last = str(tmp_path / "b.csv")
+    write_jira_file(first, [("1", "Nothing to see here")])
+    write_jira_file(last, [("1", "I need help with Python and Zotero")])
+    full_export = str(tmp_path / "full.csv")
+    incremental_export = str(tmp_path / "incremental.csv")
+    state = str(tmp_path / "state.db")
+    run_script("jira", first, last, full_export)
+    run_script("--incremental", state, "jira", first, last, incremental_export)
+    assert read_hits(full_export) == ["Python", "Zotero"]
+    assert read_hits(incremental_export) == read_hits(full_export)
+    #A second run skips the unchanged ticket and keeps its hits
+    run_script("--incremental", state, "jira", first, last, incremental_export)
+    assert read_hits(incremental_export) == read_hits(full_export)
+
+def test_duplicate_record_drops_hits_of_earlier_version(tmp_path):
+    first = str(tmp_path / "a.csv")
+    last = str(tmp_path / "b.csv")
+    write_jira_file(first, [("1", "I need help with Python and Zotero")])
+    write_jira_file(last, [("1", "Nothing to see here")])
+    incremental_export = str(tmp_path / "incremental.csv")
+    run_script("--incremental", str(tmp_path / "state.db"), "jira", first, last, incremental_export)
+    assert read_hits(incremental_export) == []